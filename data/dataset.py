@@ -1,14 +1,23 @@
 import torch
 import numpy as np
-from torch.utils.data import Dataset
-from utils.map_utils import Map, depth_to_xy, Visualizer
-from utils.utils import fig2data, AStarPlanner, MapEnvironment
-import glob, os.path as osp
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, BatchSampler, SequentialSampler, \
+    RandomSampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
+from utils.map_utils import Map, depth_to_xy, depth_to_xy_batch, Visualizer
+from utils.utils import fig2data, planner_protocol, MapEnvironment, GeodesicField
+from utils.map_cache import build_map_store, MapLRUCache
+import glob, os, os.path as osp
+import abc
+import itertools
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import math, time
+import warnings
+import cv2
 import matplotlib.pyplot as plt
 
-class cvae_dataset(Dataset):
+class map_dataset(Dataset, abc.ABC):
     def __init__(self, cfg):
 
         # store useful things ...
@@ -18,45 +27,202 @@ class cvae_dataset(Dataset):
         self.laser_max_range = cfg.data.laser_max_range
         self.n_ray = cfg.data.n_ray
         self.fov = np.deg2rad(cfg.data.fov)
+        self.raycast_method = cfg.data.get('raycast_method', 'march')
+        self.sdf_tolerance = cfg.data.get('sdf_tolerance', None)
+        self.lut_bins = cfg.data.get('lut_bins', 180)
+        self.min_free_fraction = cfg.data.get('min_free_fraction', 0.0)
 
-        self.occu_map_paths= sorted(glob.glob(osp.join(cfg.data.occu_map_dir,'*')))
-        self.length = len(self.occu_map_paths)
-
+        self.occu_map_paths = sorted(glob.glob(osp.join(cfg.data.occu_map_dir, '*')))
+        ## one sample per map and epoch unless data.samples_per_epoch is set, indices cycle through the maps
+        self.length = cfg.data.get('samples_per_epoch', None) or len(self.occu_map_paths)
+        ## compact samples and batches carry map ids, see pack() and compact_collate()
+        self.compact_batch = cfg.data.get('compact_batch', False)
+        self.map_ids = {path: i for i, path in enumerate(self.occu_map_paths)}
+
+        ## optional map cache, see utils/map_cache.py
+        self.map_store = build_map_store(cfg)
+        if self.raycast_method == 'lut' and not hasattr(self.map_store, 'get_field'):
+            raise ValueError("data.raycast_method lut needs a map store: set data.map_cache_dir, "
+                             "data.map_lru_entries, data.map_lru_bytes or data.shared_map_store")
+        self.batch_generation = cfg.data.get('batch_generation', False)
+        ## per worker counters of the map store, shared with the main process, see build_dataloader()
+        self.store_stats = None
+        ## optional background loading of the maps of the upcoming batches, see lookahead_sampler
+        self.prefetcher = None
+        if cfg.data.get('map_prefetch', 0):
+            self.prefetcher = map_prefetcher(self._load_map, cfg.data.get('map_prefetch_threads', 2),
+                                             (cfg.data.map_prefetch + 1) * cfg.data.batch_size)
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, index):
+        if isinstance(index, tuple):
+            ## a batch and the indices of the maps to load ahead, from a lookahead_sampler
+            index, upcoming = index
+            if self.prefetcher is not None:
+                self.prefetcher.schedule([self.map_path(i) for i in upcoming])
+        if isinstance(index, list):
+            ## a whole batch of indices from a batch sampler, see build_dataloader()
+            return self.get_batch(index)
+        return self.sample(self.map_path(index))
+
+    def map_path(self, index):
+        return self.occu_map_paths[index % len(self.occu_map_paths)]
+
+    def get_batch(self, indices):
+        '''
+        Generate the batch of samples of `indices`, from new random crops of their maps, at once with
+        data.batch_generation.
+        '''
+        occu_map_paths = [self.map_path(index) for index in indices]
+        maps = [self.load_map(path) for path in occu_map_paths]
+        if not self.batch_generation:
+            return self.collate([self.generate(m, path) for m, path in zip(maps, occu_map_paths)])
+        return self.generate_batch(maps, occu_map_paths)
+
+    def generate_batch(self, maps, occu_map_paths):
+        '''
+        Generate one sample from each of the loaded maps, collated like the DataLoader does.
+        '''
+        return self.collate([self.generate(m, path) for m, path in zip(maps, occu_map_paths)])
+
+    def collate(self, samples):
+        return compact_collate(samples) if self.compact_batch else default_collate(samples)
+
+    def map_meta(self, m, occu_map_path):
+        '''
+        :return: a tuple (map_id, meta) describing the loaded map `m` in compact samples: the index of
+                 `occu_map_path` in occu_map_paths, and the float64 row (W_world, H_world, resolution, crop row,
+                 crop column) of its occupancy grid, the crop offset being (0, 0) if it is not cropped.
+        '''
+        occupancy = m.get_occupancy_grid()
+        crop_row, crop_col = m.crop_window[:2] if m.crop_window is not None else (0, 0)
+        return self.map_ids[occu_map_path], np.array([occupancy.shape[1] * m.resolution,
+                                                      occupancy.shape[0] * m.resolution,
+                                                      m.resolution, crop_row, crop_col])
+
+    def pack(self, m, sample):
+        '''
+        Convert a sample (occupancy, depth_xy, state, occu_map_path, W_world, H_world) generated from `m` to the
+        compact sample (occupancy, depth_xy, state, map_id, meta) if data.compact_batch is set, see map_meta().
+        '''
+        if not self.compact_batch:
+            return sample
+        occupancy, depth_xy, state, occu_map_path = sample[:4]
+        return (occupancy, depth_xy, state) + self.map_meta(m, occu_map_path)
+
+    def pack_batch(self, maps, occu_map_paths, occupancy, depth_xy, state, W_world, H_world):
+        '''
+        Assemble the batch of samples generated from `maps` at once (see scan_batch), in the format of `collate`.
+        '''
+        if not self.compact_batch:
+            return occupancy, depth_xy, state, tuple(occu_map_paths), \
+                torch.from_numpy(W_world), torch.from_numpy(H_world)
+        ## one crop per sample, nothing to deduplicate
+        map_id, meta = zip(*[self.map_meta(m, path) for m, path in zip(maps, occu_map_paths)])
+        return occupancy, depth_xy, state, torch.arange(len(maps)), torch.tensor(map_id), \
+            torch.from_numpy(np.stack(meta))
+
+    def scan_batch(self, maps):
+        '''
+        Draw a uniformly random pose in the free space of every map and cast its scan, vectorized over the maps.
+        :return: a tuple (occupancy, depth_xy, world_pos, headings, W_world, H_world): the N x 1 x H x W uint8 tensor
+                 of the maps' occupancy grids padded with obstacles, the N x n_ray x 2 depth points clipped to
+                 the maps, the N x 2 positions, and the N headings, map widths and heights.
+        '''
+        grids, shapes = Map.stack_grids(maps, fill_value=255)
+        resolutions = np.array([m.resolution for m in maps])
+        W_world = shapes[:, 1] * resolutions
+        H_world = shapes[:, 0] * resolutions
+
+        world_pos = np.stack([m.sample_free_positions() for m in maps])
+        headings = np.deg2rad(np.random.uniform(0, 360, len(maps)))
+        depth = Map.get_1d_depth_multi(maps, world_pos, headings, self.fov, self.n_ray, grids=grids)
+        depth_xy = depth_to_xy_batch(depth, world_pos, headings, self.fov)
 
-        occu_map_path = self.occu_map_paths[index]
-
-        ## load map and random crop
-        if self.crop_size == 0:
-            m = Map(osp.join(occu_map_path, 'floorplan.yaml'), 
-                    laser_max_range=self.laser_max_range, 
-                    downsample_factor=self.downsample_factor)
+        ## clip depth
+        np.clip(depth_xy[:, :, 0], 0, W_world.reshape(-1, 1), out=depth_xy[:, :, 0])
+        np.clip(depth_xy[:, :, 1], 0, H_world.reshape(-1, 1), out=depth_xy[:, :, 1])
+
+        occupancy = torch.from_numpy(grids).unsqueeze(1) ## uint8, change shape to (N, 1, W, H)
+        return occupancy, depth_xy, world_pos, headings, W_world, H_world
+
+    def normalize_depth(self, depth_xy, world_pos, W_world, H_world):
+        '''
+        Normalize the (clipped) depth points of a scan to [0,1], relative to `world_pos` unless
+        data.world_coord_laser is set.
+        :return: a new n_ray x 2 float32 array; the arithmetic is done in float64 like before the cast.
+        '''
+        out = np.empty(depth_xy.shape, dtype=np.float32)
+        if not self.cfg.data.world_coord_laser:
+            depth_xy = depth_xy - world_pos
+        np.divide(depth_xy, np.array([W_world, H_world]), out=out)
+        return out
+
+    def sample(self, occu_map_path):
+        '''
+        Generate one sample from a new random crop of the map stored in `occu_map_path`.
+        '''
+        return self.generate(self.load_map(occu_map_path), occu_map_path)
+
+    @abc.abstractmethod
+    def generate(self, m, occu_map_path):
+        '''
+        Generate one sample from the loaded map `m`.
+        :return: a tuple (occupancy, depth_xy, state, occu_map_path, W_world, H_world).
+        '''
+
+    def stream(self, m, occu_map_path):
+        '''
+        Generate samples from the loaded map `m` until no more can be generated from it.
+        '''
+        while True:
+            sample = self.generate(m, occu_map_path)
+            if sample is None:
+                return
+            yield sample
+
+    def load_map(self, occu_map_path):
+        '''
+        Load the map stored in `occu_map_path` and random crop it (crop_size 0 means no crop). Taken from the
+        prefetched maps if it was loaded ahead.
+        '''
+        if self.prefetcher is not None:
+            m = self.prefetcher.get(occu_map_path)
         else:
-            m = Map(osp.join(occu_map_path, 'floorplan.yaml'), 
-                    laser_max_range=self.laser_max_range, 
-                    downsample_factor=self.downsample_factor,
-                    crop_size=self.crop_size)
+            m = self._load_map(occu_map_path)
+        if self.store_stats is not None:
+            worker = get_worker_info()
+            stats = self.map_store.stats()
+            self.store_stats[0 if worker is None else worker.id] = torch.tensor(
+                [stats[k] for k in MapLRUCache.stat_keys])
+        return m
+
+    def _load_map(self, occu_map_path):
+        return Map(osp.join(occu_map_path, 'floorplan.yaml'),
+                   laser_max_range=self.laser_max_range,
+                   downsample_factor=self.downsample_factor,
+                   crop_size=self.crop_size if self.crop_size > 0 else None,
+                   store=self.map_store,
+                   raycast_method=self.raycast_method,
+                   sdf_tolerance=self.sdf_tolerance,
+                   lut_bins=self.lut_bins,
+                   min_free_fraction=self.min_free_fraction)
+
+
+class cvae_dataset(map_dataset):
+    def __init__(self, cfg):
+        super(cvae_dataset, self).__init__(cfg)
+
+    def generate(self, m, occu_map_path):
 
         occupancy = m.get_occupancy_grid()
         W_world = occupancy.shape[1]*m.resolution
         H_world = occupancy.shape[0]*m.resolution
 
         ## uniformly random sample state in freespace
-        while True:
-            world_pos_x = np.random.uniform(0, W_world, 1)[0]
-            world_pos_y = np.random.uniform(0, H_world, 1)[0]
-            grid_pos_x, grid_pos_y = m.grid_coord(world_pos_x, world_pos_y)
-            grid_pos_x = np.clip(grid_pos_x, 0, occupancy.shape[1]-1)
-            grid_pos_y = np.clip(grid_pos_y, 0, occupancy.shape[0]-1)
-
-            if occupancy[grid_pos_y, grid_pos_x]== 0:
-                break
-        
-        world_pos = np.array([world_pos_x, world_pos_y])
+        world_pos = m.sample_free_positions()
         ## uniformly random sample heading
         heading = np.random.uniform(0, 360, 1)[0]
         heading = np.deg2rad(heading)
@@ -67,205 +233,190 @@ class cvae_dataset(Dataset):
         np.clip(depth_xy[:, 0], 0, W_world, out=depth_xy[:, 0])
         np.clip(depth_xy[:, 1], 0, H_world, out=depth_xy[:, 1])
 
-        ## normalize state position and depth info to [0,1]
-        if self.cfg.data.world_coord_laser:
-            depth_xy[:, 0] = (depth_xy[:, 0]) / W_world
-            depth_xy[:, 1] = (depth_xy[:, 1]) / H_world
-        else:
-            depth_xy[:,0] = (depth_xy[:,0] - world_pos_x)/W_world
-            depth_xy[:,1] = (depth_xy[:,1] - world_pos_y)/H_world
-        world_pos_x = world_pos_x/W_world
-        world_pos_y = world_pos_y/H_world
-        heading = heading/(2*math.pi)
+        ## normalize state position and depth info to [0,1], straight into the float32 sample buffers
+        depth_xy = self.normalize_depth(depth_xy, world_pos, W_world, H_world)
+        state = np.empty(3, dtype=np.float32)
+        state[:2] = world_pos / np.array([W_world, H_world])
+        state[2] = heading / (2 * math.pi)
 
-    
-        state = torch.Tensor(np.array([world_pos_x, world_pos_y, heading]))
-        occupancy = torch.Tensor(occupancy).unsqueeze(0) ## change shape to (1, W, H)
-        depth_xy = torch.Tensor(depth_xy).view(-1)
+        state = torch.from_numpy(state)
+        occupancy = torch.from_numpy(occupancy).unsqueeze(0) ## uint8 view, change shape to (1, W, H)
+        depth_xy = torch.from_numpy(depth_xy).view(-1)
 
-        return occupancy, depth_xy, state, occu_map_path, W_world, H_world
+        return self.pack(m, (occupancy, depth_xy, state, occu_map_path, W_world, H_world))
 
+    def generate_batch(self, maps, occu_map_paths):
+        occupancy, depth_xy, world_pos, headings, W_world, H_world = self.scan_batch(maps)
+        extent = np.stack([W_world, H_world], axis=1)
 
-class seq_cvae_dataset(Dataset):
-    def __init__(self, cfg):
+        ## normalize state position and depth info to [0,1]
+        if not self.cfg.data.world_coord_laser:
+            depth_xy -= world_pos.reshape(-1, 1, 2)
+        depth_xy /= extent.reshape(-1, 1, 2)
+        state = np.empty((len(maps), 3), dtype=np.float32)
+        state[:, :2] = world_pos / extent
+        state[:, 2] = headings / (2 * math.pi)
 
-        # store useful things ...
-        self.cfg = cfg
-        self.crop_size = cfg.data.crop_size
-        self.downsample_factor = cfg.data.downsample_factor
-        self.laser_max_range = cfg.data.laser_max_range
-        self.n_ray = cfg.data.n_ray
-        self.fov = np.deg2rad(cfg.data.fov)
+        depth_xy = torch.from_numpy(depth_xy.reshape(len(maps), -1).astype(np.float32))
+        return self.pack_batch(maps, occu_map_paths, occupancy, depth_xy, torch.from_numpy(state), W_world, H_world)
 
-        self.occu_map_paths = sorted(glob.glob(osp.join(cfg.data.occu_map_dir, '*')))
-        self.length = len(self.occu_map_paths)
 
-    def __len__(self):
-        return self.length
+class seq_cvae_dataset(map_dataset):
+    ## start cells tried per crop before giving up on it
+    max_attempts = 10
 
-    def __getitem__(self, index):
+    def __init__(self, cfg):
+        super(seq_cvae_dataset, self).__init__(cfg)
+        self.planner = cfg.data.get('planner', 'geodesic')
+        if self.planner != 'geodesic':
+            self.planner = planner_protocol[self.planner]
+        ## random crops tried by sample() before giving up on a map
+        self.max_crop_attempts = cfg.data.get('max_crop_attempts', 100)
+
+    def get_batch(self, indices):
+        ## sequences may need new crops, see sample()
+        return self.collate([self.sample(self.map_path(index)) for index in indices])
+
+    def sample(self, occu_map_path):
+        ## new random crop when there is no path longer than the horizon in this one
+        for _ in range(self.max_crop_attempts):
+            m = self.load_map(occu_map_path)
+            sample = self.generate(m, occu_map_path)
+            if sample is not None:
+                return sample
+        raise RuntimeError("no path longer than data.horizon ({}) in {} random crops of {}, see "
+                           "data.max_crop_attempts".format(self.cfg.data.horizon, self.max_crop_attempts,
+                                                           occu_map_path))
+
+    def paths(self, occupancy):
+        '''
+        Draw a start cell and grow its geodesic field (a shortest-path tree), then draw goals among the cells more
+        than `horizon` moves away from the start and plan the paths to them.
+        :return: a generator of [2 x n] numpy arrays of the cells of the paths, n > horizon. Empty if there is no
+                 such path.
+        '''
+        horizon = self.cfg.data.horizon
+        free = occupancy == 0
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(free.astype(np.uint8), connectivity=8)
+        ## start from the components with enough cells for a long enough path
+        large = np.flatnonzero(stats[:, cv2.CC_STAT_AREA] > horizon)
+        large = large[large > 0]
+        if len(large) == 0:
+            return
+        starts = np.flatnonzero(np.isin(labels, large))
+
+        for _ in range(self.max_attempts):
+            grid_pos_y, grid_pos_x = divmod(np.random.choice(starts), occupancy.shape[1])
+            start_config = np.array([[grid_pos_x], [grid_pos_y]])
+            field = GeodesicField(free, start_config, labels, stats)
+            goals = field.cells(min_hops=horizon)
+            if goals.shape[1] > 0:
+                break
+        else:
+            return
 
-        good_to_go = False
-        while not good_to_go:
-            s = time.time()
-            timeout = False
-            if self.cfg.mode == "train":
-                occu_map_path = np.random.choice(self.occu_map_paths)
-            else:
-                occu_map_path = self.occu_map_paths[index]
-            #occu_map_path = self.occu_map_paths[index]
-
-            ## load map and random crop
-            if self.crop_size == 0:
-                m = Map(osp.join(occu_map_path, 'floorplan.yaml'),
-                        laser_max_range=self.laser_max_range,
-                        downsample_factor=self.downsample_factor)
+        while True:
+            goal_config = goals[:, [np.random.randint(goals.shape[1])]]
+            if self.planner == 'geodesic':
+                yield field.path_to(goal_config)
             else:
-                m = Map(osp.join(occu_map_path, 'floorplan.yaml'),
-                        laser_max_range=self.laser_max_range,
-                        downsample_factor=self.downsample_factor,
-                        crop_size=self.crop_size)
-
-            occupancy = m.get_occupancy_grid()
-            W_world = occupancy.shape[1] * m.resolution
-            H_world = occupancy.shape[0] * m.resolution
-
-            ## uniformly random sample state in freespace
-            while True:
-                if time.time() - s > 10:
-                    timeout = True
-                    break
-                while True:
-                    world_pos_x = np.random.uniform(0, W_world, 1)[0]
-                    world_pos_y = np.random.uniform(0, H_world, 1)[0]
-                    grid_pos_x, grid_pos_y = m.grid_coord(world_pos_x, world_pos_y)
-                    grid_pos_x = np.clip(grid_pos_x, 0, occupancy.shape[1] - 1)
-                    grid_pos_y = np.clip(grid_pos_y, 0, occupancy.shape[0] - 1)
-
-                    if occupancy[grid_pos_y, grid_pos_x] == 0:
-                        break
-                    if time.time() - s > 10:
-                        timeout = True
-                        break
-                if timeout:
-                    break
-
-                while True:
-                    goal_world_pos_x = np.random.uniform(0, W_world, 1)[0]
-                    goal_world_pos_y = np.random.uniform(0, H_world, 1)[0]
-                    goal_grid_pos_x, goal_grid_pos_y = m.grid_coord(goal_world_pos_x, goal_world_pos_y)
-                    goal_grid_pos_x = np.clip(goal_grid_pos_x, 0, occupancy.shape[1] - 1)
-                    goal_grid_pos_y = np.clip(goal_grid_pos_y, 0, occupancy.shape[0] - 1)
-
-                    if occupancy[goal_grid_pos_y, goal_grid_pos_x] == 0:
-                        break
-                    if time.time() - s > 10:
-                        timeout = True
-                        break
-                if timeout:
-                    break
-
-                start_config = np.array([[grid_pos_x], [grid_pos_y]])
-                goal_config = np.array([[goal_grid_pos_x], [goal_grid_pos_y]])
+                ## any path to the goal has at least horizon + 1 cells
                 env = MapEnvironment(occupancy, start_config, goal_config, self.cfg.data.epsilon)
-                planner = AStarPlanner(env, 10)
-                plan = planner.Plan(start_config, goal_config)
-                if plan.shape[1] > self.cfg.data.horizon:
-                    good_to_go = True
-                    break
-            if not timeout:
-                break
-
+                yield self.planner(env, 10).Plan(start_config, goal_config)
+
+    def windows(self, occupancy):
+        '''
+        Cut the paths of `paths` into windows of `horizon` cells, every `window_stride` cells from the start.
+        Windows already generated from this crop are skipped.
+        :return: a generator of [2 x horizon] numpy arrays. Stops when `max_attempts` paths in a row give no new
+                 window.
+        '''
+        horizon = self.cfg.data.horizon
+        stride = self.cfg.data.get('window_stride', None) or horizon
+        seen = set()
+        misses = 0
+        for plan in self.paths(occupancy):
+            misses += 1
+            for i in range(0, plan.shape[1] - horizon + 1, stride):
+                window = plan[:, i:i + horizon]
+                key = window.tobytes()
+                if key not in seen:
+                    seen.add(key)
+                    misses = 0
+                    yield window
+            if misses >= self.max_attempts:
+                return
+
+    def stream(self, m, occu_map_path):
+        '''
+        Generate sequences along many paths of one shortest-path tree of the crop, see `windows`.
+        '''
+        occupancy = m.get_occupancy_grid()
+        for plan in self.windows(occupancy):
+            yield self.render(m, occupancy, plan, occu_map_path)
+
+    def generate(self, m, occu_map_path):
+        '''
+        :return: a sample, or None if no path longer than the horizon was found in this crop.
+        '''
+        return next(self.stream(m, occu_map_path), None)
+
+    def render(self, m, occupancy, plan, occu_map_path):
+        '''
+        :return: the sample of the sequence along the first `horizon` cells of `plan`, with a random heading.
+        '''
+        W_world = occupancy.shape[1] * m.resolution
+        H_world = occupancy.shape[0] * m.resolution
 
-        depth_xy_seq, state_seq = [], []
+        horizon = self.cfg.data.horizon
+        ## cast and post-process the scans of the whole horizon at once
         heading = np.random.uniform(0, 360, 1)[0]
         heading = np.deg2rad(heading)
         heading_normalized = heading / (2 * math.pi)
-        for i in range(self.cfg.data.horizon):
-            world_pos_x, world_pos_y = m.world_coord(plan[0, i], plan[1, i])
-
-            world_pos = np.array([world_pos_x, world_pos_y])
-            ## uniformly random sample heading
-            depth = m.get_1d_depth(world_pos, heading, self.fov, self.n_ray)
-            depth_xy = depth_to_xy(depth, world_pos, heading, self.fov)
-
-            ## clip depth
-            np.clip(depth_xy[:, 0], 0, W_world, out=depth_xy[:, 0])
-            np.clip(depth_xy[:, 1], 0, H_world, out=depth_xy[:, 1])
-
-            ## normalize state position and depth info to [0,1]
-            if self.cfg.data.world_coord_laser:
-                depth_xy[:, 0] = (depth_xy[:, 0]) / W_world
-                depth_xy[:, 1] = (depth_xy[:, 1]) / H_world
-            else:
-                depth_xy[:, 0] = (depth_xy[:, 0] - world_pos_x) / W_world
-                depth_xy[:, 1] = (depth_xy[:, 1] - world_pos_y) / H_world
-            world_pos_x = world_pos_x / W_world
-            world_pos_y = world_pos_y / H_world
+        world_pos = m.world_coord_batch(plan[:, :horizon].T)
+        headings = np.full(horizon, heading)
+        depth = m.get_1d_depth_batch(world_pos, headings, self.fov, self.n_ray)
+        depth_xy = depth_to_xy_batch(depth, world_pos, headings, self.fov)
 
-            state = torch.Tensor(np.array([world_pos_x, world_pos_y, heading_normalized]))
-            depth_xy = torch.Tensor(depth_xy).view(-1)
+        ## clip depth
+        np.clip(depth_xy[:, :, 0], 0, W_world, out=depth_xy[:, :, 0])
+        np.clip(depth_xy[:, :, 1], 0, H_world, out=depth_xy[:, :, 1])
 
-            depth_xy_seq.append(depth_xy.unsqueeze(0))
-            state_seq.append(state.unsqueeze(0))
-        depth_xy_seq = torch.cat(depth_xy_seq)
-        state_seq = torch.cat(state_seq)
+        ## normalize state position and depth info to [0,1]
+        depth_xy_seq = np.empty((horizon, depth_xy.shape[1] * 2), dtype=np.float32)
+        state_seq = np.empty((horizon, 3), dtype=np.float32)
+        if not self.cfg.data.world_coord_laser:
+            depth_xy -= world_pos[:, None, :]
+        depth_xy /= np.array([W_world, H_world])
+        depth_xy_seq[:] = depth_xy.reshape(horizon, -1)
+        state_seq[:, :2] = world_pos / np.array([W_world, H_world])
+        state_seq[:, 2] = heading_normalized
+        depth_xy_seq = torch.from_numpy(depth_xy_seq)
+        state_seq = torch.from_numpy(state_seq)
 
-        occupancy = torch.Tensor(occupancy).unsqueeze(0)  ## change shape to (1, W, H)
+        occupancy = torch.from_numpy(occupancy).unsqueeze(0)  ## uint8 view, change shape to (1, W, H)
 
-        return occupancy, depth_xy_seq, state_seq, occu_map_path, W_world, H_world
+        return self.pack(m, (occupancy, depth_xy_seq, state_seq, occu_map_path, W_world, H_world))
 
 
-class cnn_dataset(Dataset):
+class cnn_dataset(map_dataset):
     def __init__(self, cfg):
-        self.cfg = cfg
-        
+        super(cnn_dataset, self).__init__(cfg)
+
         self.a = cfg.model
-        
-        self.crop_size = cfg.data.crop_size
-        self.downsample_factor = cfg.data.downsample_factor
-        self.laser_max_range = cfg.data.laser_max_range
-        self.n_ray = cfg.data.n_ray
+
         self.fov = cfg.data.fov
 
         self.num_bin = cfg.data.num_bin
 
-        self.occu_map_paths= sorted(glob.glob(osp.join(cfg.data.occu_map_dir,'*')))
-        self.length = len(self.occu_map_paths)
-
-    def __len__(self):
-        return self.length
-
-    def __getitem__(self, index):
-        occu_map_path = self.occu_map_paths[index]
-
-        ## load map and random crop
-        if self.crop_size == 0:
-            m = Map(osp.join(occu_map_path, 'floorplan.yaml'),
-                    laser_max_range=self.laser_max_range,
-                    downsample_factor=self.downsample_factor)
-        else:
-            m = Map(osp.join(occu_map_path, 'floorplan.yaml'),
-                    laser_max_range=self.laser_max_range,
-                    downsample_factor=self.downsample_factor,
-                    crop_size=self.crop_size)
+    def generate(self, m, occu_map_path):
 
         occupancy = m.get_occupancy_grid()
         W_world = occupancy.shape[1] * m.resolution
         H_world = occupancy.shape[0] * m.resolution
 
         ## uniformly random sample state in freespace
-        while True:
-            world_pos_x = np.random.uniform(0, W_world, 1)[0]
-            world_pos_y = np.random.uniform(0, H_world, 1)[0]
-            grid_pos_x, grid_pos_y = m.grid_coord(world_pos_x, world_pos_y)
-            grid_pos_x = np.clip(grid_pos_x, 0, occupancy.shape[1] - 1)
-            grid_pos_y = np.clip(grid_pos_y, 0, occupancy.shape[0] - 1)
-
-            if occupancy[grid_pos_y, grid_pos_x] == 0:
-                break
-
-        world_pos = np.array([world_pos_x, world_pos_y])
+        world_pos = m.sample_free_positions()
         ## uniformly random sample heading
         heading = np.random.uniform(0, 360, 1)[0]
         heading = np.deg2rad(heading)
@@ -276,21 +427,389 @@ class cnn_dataset(Dataset):
         np.clip(depth_xy[:, 0], 0, W_world, out=depth_xy[:, 0])
         np.clip(depth_xy[:, 1], 0, H_world, out=depth_xy[:, 1])
 
-        ## normalize state position and depth info to [0,1]
-        if self.cfg.data.world_coord_laser:
-            depth_xy[:, 0] = (depth_xy[:, 0]) / W_world
-            depth_xy[:, 1] = (depth_xy[:, 1]) / H_world
-        else:
-            depth_xy[:,0] = (depth_xy[:,0] - world_pos_x)/W_world
-            depth_xy[:,1] = (depth_xy[:,1] - world_pos_y)/H_world
-        world_pos_x_cls = (world_pos_x) // (W_world / self.num_bin)
-        world_pos_y_cls = (world_pos_y) // (H_world / self.num_bin)
+        ## normalize depth info to [0,1] and bin the state, straight into the sample buffers
+        depth_xy = self.normalize_depth(depth_xy, world_pos, W_world, H_world)
+        cls = np.empty(3, dtype=np.int64)
+        cls[:2] = world_pos // (np.array([W_world, H_world]) / self.num_bin)
         heading = heading / (2 * math.pi)
-        heading_cls = (heading) // (1 / self.num_bin)
-        cls = np.array([world_pos_x_cls, world_pos_y_cls, heading_cls])
+        cls[2] = heading // (1 / self.num_bin)
+
+        cls = torch.from_numpy(cls)
+        occupancy = torch.from_numpy(occupancy).unsqueeze(0) ## uint8 view, change shape to (1, W, H)
+        depth_xy = torch.from_numpy(depth_xy).view(-1)
+
+        return self.pack(m, (occupancy, depth_xy, cls, occu_map_path, W_world, H_world))
+
+    def generate_batch(self, maps, occu_map_paths):
+        occupancy, depth_xy, world_pos, headings, W_world, H_world = self.scan_batch(maps)
+        extent = np.stack([W_world, H_world], axis=1)
+
+        ## normalize depth info to [0,1] and bin the state
+        if not self.cfg.data.world_coord_laser:
+            depth_xy -= world_pos.reshape(-1, 1, 2)
+        depth_xy /= extent.reshape(-1, 1, 2)
+        cls = np.empty((len(maps), 3), dtype=np.int64)
+        cls[:, :2] = world_pos // (extent / self.num_bin)
+        cls[:, 2] = (headings / (2 * math.pi)) // (1 / self.num_bin)
+
+        depth_xy = torch.from_numpy(depth_xy.reshape(len(maps), -1).astype(np.float32))
+        return self.pack_batch(maps, occu_map_paths, occupancy, depth_xy, torch.from_numpy(cls), W_world, H_world)
+
+
+class map_prefetcher(object):
+    '''
+    Loads maps ahead of time on a small thread pool: file reads and cv2 decoding release the GIL, so they overlap
+    with the raycasting and sampling of the DataLoader worker. At most `depth` maps are loaded or held at a time, and
+    at most `depth` more wait in a queue: maps scheduled beyond that are loaded when asked for.
+    '''
+
+    def __init__(self, load_fn, num_threads=2, depth=16):
+        '''
+        :param load_fn: function loading a map from its key (a map path), called from the threads.
+        :param num_threads: number of loading threads.
+        :param depth: maximum number of maps loaded or held ahead.
+        '''
+        self.load_fn = load_fn
+        self.num_threads = num_threads
+        self.depth = depth
+        self.pool = None
+        self.pid = None
+        self.pending = deque() ## keys waiting for a free slot, at most depth
+        self.loading = deque() ## (key, future) of the maps loaded ahead, at most depth
+
+    def __getstate__(self):
+        ## threads are not inherited by the workers, they start their own pool
+        state = self.__dict__.copy()
+        state.update(pool=None, pid=None, pending=deque(), loading=deque())
+        return state
+
+    def _fill(self):
+        if self.pid != os.getpid():
+            ## first use, or the pool of the parent process before a fork
+            self.pool = ThreadPoolExecutor(self.num_threads)
+            self.pid = os.getpid()
+            self.loading.clear()
+        while self.pending and len(self.loading) < self.depth:
+            key = self.pending.popleft()
+            self.loading.append((key, self.pool.submit(self.load_fn, key)))
+
+    def schedule(self, keys):
+        '''
+        Queue the maps of `keys` for loading, in order.
+        '''
+        self.pending.extend(keys)
+        self._fill()
+        ## the latest keys are the furthest ahead
+        while len(self.pending) > self.depth:
+            self.pending.pop()
+
+    def get(self, key):
+        '''
+        :return: the oldest map loaded ahead for `key`, waiting for it if needed. Loaded right away if there is none.
+        '''
+        for i, (k, future) in enumerate(self.loading):
+            if k == key:
+                del self.loading[i]
+                self._fill()
+                return future.result()
+        if key in self.pending:
+            self.pending.remove(key)
+        elif len(self.loading) >= self.depth:
+            ## maps that were scheduled but never asked for (e.g. an epoch left early) should not block the queue
+            self.loading.popleft()
+            self._fill()
+        return self.load_fn(key)
+
+
+class map_major_dataset(IterableDataset):
+    '''
+    Streams the samples of a map dataset map by map: every map is loaded (and random cropped) once and
+    `samples_per_crop` samples are generated from it before it is dropped. Each worker keeps `interleave` crops
+    open and takes its samples from them in turn, so consecutive samples, and thus batches, still mix maps.
+    An epoch has as many samples as the wrapped dataset.
+    '''
+
+    def __init__(self, source, samples_per_crop, interleave=4, shuffle=True):
+        '''
+        :param source: a map_dataset, provides the maps, load_map and stream.
+        :param samples_per_crop: number of samples generated from every loaded crop.
+        :param interleave: number of crops each worker draws samples from at the same time.
+        :param shuffle: if True the maps are visited in a new random order every epoch, else in order.
+        '''
+        self.source = source
+        self.samples_per_crop = samples_per_crop
+        self.interleave = interleave
+        self.shuffle = shuffle
+        self.occu_map_paths = source.occu_map_paths
+        ## epochs iterated by this copy of the dataset, persistent workers keep theirs across epochs
+        self.epoch = 0
 
-        cls = torch.LongTensor(cls)
-        occupancy = torch.Tensor(occupancy).unsqueeze(0) ## change shape to (1, W, H)
-        depth_xy = torch.Tensor(depth_xy).view(-1)
+    def __len__(self):
+        return len(self.source)
+
+    def load_map(self, occu_map_path):
+        return self.source.load_map(occu_map_path)
 
-        return occupancy, depth_xy, cls, occu_map_path, W_world, H_world
+    def map_order(self, rng, worker_id, num_workers):
+        ## endless stream of map paths for one worker
+        paths = self.occu_map_paths
+        while True:
+            if self.shuffle:
+                ## workers draw their own orders, so they do not run out of maps when there are few
+                for i in rng.permutation(len(paths)):
+                    yield paths[i]
+            else:
+                for path in paths[worker_id::num_workers] or paths:
+                    yield path
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is None:
+            worker_id, num_workers = 0, 1
+            seed = int(torch.empty((), dtype=torch.int64).random_())
+        else:
+            worker_id, num_workers = worker.id, worker.num_workers
+            seed = worker.seed
+        ## the worker seed does not change between the epochs of persistent workers
+        rng = np.random.RandomState([seed % 2**32, self.epoch])
+        self.epoch += 1
+        n = len(self) // num_workers + (worker_id < len(self) % num_workers)
+        paths = self.map_order(rng, worker_id, num_workers)
+
+        crops = [] ## [sample generator, remaining samples]
+        slot = 0
+        while n > 0:
+            while len(crops) < self.interleave:
+                occu_map_path = next(paths)
+                m = self.source.load_map(occu_map_path)
+                crops.append([self.source.stream(m, occu_map_path), self.samples_per_crop])
+            slot = slot % len(crops)
+            samples, remaining = crops[slot]
+            sample = next(samples, None)
+            if sample is None or remaining <= 1:
+                ## used up, or no more samples can be generated from this crop
+                crops.pop(slot)
+            else:
+                crops[slot][1] -= 1
+                slot += 1
+            if sample is not None:
+                n -= 1
+                yield sample
+
+
+def compact_collate(samples):
+    '''
+    Collate compact samples (occupancy, depth_xy, state, map_id, meta) into a compact batch
+    (occupancy, depth_xy, state, occupancy_index, map_id, meta): samples sharing an occupancy grid (same crop, as in
+    map-major or sequence batches) share one of the U unique U x 1 x H x W grids, `occupancy_index` gives the grid of
+    every sample, and `map_id` and the U x 5 `meta` table describe the grids, see map_dataset.map_meta().
+    '''
+    grids, index, map_id, meta = [], [], [], []
+    keys = {}
+    for occupancy, _, _, sample_map_id, sample_meta in samples:
+        ## samples of the same crop are views of the same grid
+        key = (occupancy.data_ptr(), tuple(occupancy.shape), occupancy.stride())
+        if key not in keys:
+            keys[key] = len(grids)
+            grids.append(occupancy)
+            map_id.append(sample_map_id)
+            meta.append(sample_meta)
+        index.append(keys[key])
+    depth_xy, state = default_collate([sample[1:3] for sample in samples])
+    return default_collate(grids), depth_xy, state, torch.tensor(index), torch.tensor(map_id), \
+        torch.from_numpy(np.stack(meta))
+
+
+def unpack_batch(batch, occu_map_paths, device=None):
+    '''
+    Bring a batch in either format to the (occupancy, depth_xy, state, occu_map_paths, W_world, H_world) one.
+    :param occu_map_paths: the map paths of the dataset, indexed by the map ids of compact batches.
+    :param device: if not None, the tensors are moved to it first, so only the unique grids of a compact batch are
+                   transferred before they are expanded to one per sample.
+    '''
+    if device is not None:
+        batch = [x.to(device=device) if torch.is_tensor(x) else x for x in batch]
+    if not torch.is_tensor(batch[3]):
+        return tuple(batch)
+    occupancy, depth_xy, state, index, map_id, meta = batch
+    meta = meta[index]
+    paths = [occu_map_paths[i] for i in map_id[index].tolist()]
+    return occupancy[index], depth_xy, state, paths, meta[:, 0], meta[:, 1]
+
+
+class worker_affine_sampler(Sampler):
+    '''
+    Batch sampler of map datasets that gives every DataLoader worker its own share of the maps, so that each worker
+    keeps coming back to a small set of maps and its map cache (data.map_lru_entries) stays hot.
+
+    The sampler relies on the DataLoader handing the batches to its workers in turn, batch b of an epoch going to
+    worker b % num_workers (the order of torch's DataLoader, not a documented guarantee): batch b is drawn from the
+    maps of that worker. With another order the batches are the same but the affinity is lost. The maps are split
+    into num_workers groups once, and the groups are rotated among the workers every epoch so that all maps are
+    covered even when an epoch has fewer batches than there are workers. A per-worker cache the size of a group
+    then only misses at the first visit of an epoch. With more workers than maps there is one group per map and
+    several workers share each group, which still keeps every worker on a single map.
+    '''
+
+    def __init__(self, n_maps, length, batch_size, num_workers, shuffle=True):
+        '''
+        :param n_maps: number of maps of the dataset, the sampled indices are map indices.
+        :param length: number of samples per epoch.
+        :param batch_size: number of samples per batch, the last batch of an epoch may be smaller.
+        :param num_workers: number of DataLoader workers (0 is one group of all maps).
+        :param shuffle: if True the maps are grouped at random and visited in a new random order every epoch,
+                        else the groups are contiguous ranges of maps visited in order.
+        '''
+        self.length = length
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.num_groups = min(self.num_workers, n_maps)
+        if self.num_groups < self.num_workers:
+            warnings.warn("worker_affine_sampler: {} workers for {} maps, workers share their maps".format(
+                num_workers, n_maps))
+        self.shuffle = shuffle
+        self.epoch = 0
+        maps = np.arange(n_maps)
+        if shuffle:
+            ## drawn from the torch generator, as the DataLoader's own samplers
+            rng = np.random.RandomState(int(torch.empty((), dtype=torch.int64).random_()) % 2**32)
+            maps = rng.permutation(maps)
+        self.groups = np.array_split(maps, self.num_groups)
+
+    def __len__(self):
+        return (self.length + self.batch_size - 1) // self.batch_size
+
+    def group_indices(self, group, rng):
+        ## endless stream of the map indices of a group
+        while True:
+            for index in (rng.permutation(group) if self.shuffle else group):
+                yield index
+
+    def __iter__(self):
+        rng = np.random.RandomState(int(torch.empty((), dtype=torch.int64).random_()) % 2**32)
+        ## worker w draws from group (w + epoch) % num_groups
+        streams = [self.group_indices(self.groups[(w + self.epoch) % self.num_groups], rng)
+                   for w in range(self.num_workers)]
+        self.epoch += 1
+        for b in range(len(self)):
+            size = min(self.batch_size, self.length - b * self.batch_size)
+            stream = streams[b % self.num_workers]
+            yield [int(next(stream)) for _ in range(size)]
+
+
+class lookahead_sampler(Sampler):
+    '''
+    Wraps a batch sampler to tell every DataLoader worker which maps its next batches use, so that its
+    map_prefetcher loads them in the background. Each batch comes with the indices of the batch `lookahead` batches
+    ahead of it on the same worker (batch b goes to worker b % num_workers), and the first batch of every worker also
+    with its own indices and those of the batches in between. Only the next `lookahead * num_workers + 1` batches of
+    the wrapped sampler are held at a time.
+    '''
+
+    def __init__(self, batch_sampler, num_workers, lookahead=1):
+        self.batch_sampler = batch_sampler
+        self.num_workers = max(num_workers, 1)
+        self.lookahead = lookahead
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        W = self.num_workers
+        batches = iter(self.batch_sampler)
+        ## batches b to b + lookahead * W
+        window = deque(list(indices) for indices in itertools.islice(batches, self.lookahead * W + 1))
+        b = 0
+        while window:
+            ahead = range(0 if b < W else self.lookahead, self.lookahead + 1)
+            upcoming = [i for k in ahead if k * W < len(window) for i in window[k * W]]
+            yield window.popleft(), upcoming
+            window.extend(list(indices) for indices in itertools.islice(batches, 1))
+            b += 1
+
+
+def seed_worker(worker_id):
+    '''
+    worker_init_fn of the DataLoaders. Forked workers inherit the NumPy and `random` states of the main process, and
+    torch before 1.9 leaves them as they are, so all workers would generate the same samples. Seed them with the
+    worker's torch seed, which differs between workers and between runs (and between epochs, unless the workers are
+    persistent and simply carry on).
+    '''
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def map_store_stats(dataset):
+    '''
+    :param dataset: a dataset passed to build_dataloader().
+    :return: a list with the map store counters (see MapLRUCache.stats) of every DataLoader worker as of its last
+             map load, empty if the map store keeps none.
+    '''
+    stats = getattr(getattr(dataset, 'source', dataset), 'store_stats', None)
+    if stats is None:
+        return []
+    return [dict(zip(MapLRUCache.stat_keys, row)) for row in stats.tolist()]
+
+
+dataset_protocol = {"cvae": cvae_dataset,
+                    "cnn": cnn_dataset,
+                    "cls": cvae_dataset,
+                    "reg": cvae_dataset,
+                    "seq_cvae": seq_cvae_dataset,}
+
+
+def build_dataset(cfg):
+    '''
+    Dataset of the training and testing loops: the samples pre-rendered in data.rendered_dir (see
+    data/sample_store.py), or the map dataset of data.protocol, which with data.samples_per_crop draws several
+    samples per map load (see map_major_dataset).
+    '''
+    if cfg.data.get('rendered_dir', None):
+        ## imported here, data.sample_store imports this module
+        from data import sample_store
+        return sample_store.rendered_dataset(cfg)
+    dataset = dataset_protocol[cfg.data.protocol](cfg)
+    if cfg.data.get('samples_per_crop', None):
+        dataset = map_major_dataset(dataset, cfg.data.samples_per_crop, cfg.data.get('crop_interleave', 4),
+                                    shuffle=cfg.mode == "train")
+    return dataset
+
+
+def build_dataloader(cfg, dataset):
+    '''
+    DataLoader of the training and testing loops. The maps of map datasets are visited in a random order in train
+    mode, and each worker gets its own share of them with data.worker_affine (see worker_affine_sampler). With
+    data.batch_generation, the map datasets generate whole batches at once: the batch sampler hands lists of indices
+    to `map_dataset.__getitem__`. With data.map_prefetch, they also get the maps of the next data.map_prefetch
+    batches of their worker to load in the background (see lookahead_sampler). With data.compact_batch, the
+    batches are compact ones, see compact_collate(). framework.persistent_workers keeps the workers alive between
+    epochs, and each of them loads framework.prefetch_factor batches in advance.
+    '''
+    num_workers = cfg.framework.num_thread
+    kwargs = {"num_workers": num_workers, "worker_init_fn": seed_worker}
+    if num_workers > 0:
+        kwargs["persistent_workers"] = cfg.framework.get('persistent_workers', False)
+        kwargs["prefetch_factor"] = cfg.framework.get('prefetch_factor', 2)
+    collate_fn = compact_collate if cfg.data.get('compact_batch', False) else default_collate
+    source = getattr(dataset, 'source', dataset)
+    if isinstance(source, map_dataset) and hasattr(source.map_store, 'stats'):
+        ## written by the workers, read with map_store_stats()
+        source.store_stats = torch.zeros((max(num_workers, 1), len(MapLRUCache.stat_keys)),
+                                         dtype=torch.int64).share_memory_()
+    if not isinstance(dataset, map_dataset):
+        ## iterable datasets order their samples themselves
+        return DataLoader(dataset, batch_size=cfg.data.batch_size, collate_fn=collate_fn, **kwargs)
+
+    shuffle = cfg.mode == "train"
+    if cfg.data.get('worker_affine', False):
+        batch_sampler = worker_affine_sampler(len(dataset.occu_map_paths), len(dataset), cfg.data.batch_size,
+                                              num_workers, shuffle)
+    else:
+        batch_sampler = BatchSampler(RandomSampler(dataset) if shuffle else SequentialSampler(dataset),
+                                     cfg.data.batch_size, drop_last=False)
+    if cfg.data.get('map_prefetch', 0):
+        batch_sampler = lookahead_sampler(batch_sampler, num_workers, cfg.data.map_prefetch)
+    if cfg.data.get('batch_generation', False) or cfg.data.get('map_prefetch', 0):
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None, **kwargs)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **kwargs)
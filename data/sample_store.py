@@ -0,0 +1,303 @@
+"""offline rendering of training samples into sharded, memory-mapped arrays and the dataset reading them back."""
+import argparse
+import glob
+import multiprocessing
+import os
+import os.path as osp
+import shutil
+import time
+
+import numpy as np
+import random
+import torch
+import yaml
+from torch.utils.data import IterableDataset, get_worker_info
+
+from data import dataset
+from utils.config import Config
+
+## data settings that change the rendered samples, recorded in the manifest
+render_keys = ["protocol", "crop_size", "min_free_fraction", "downsample_factor", "laser_max_range", "n_ray", "fov",
+               "raycast_method", "sdf_tolerance", "lut_bins", "world_coord_laser", "num_bin", "horizon", "epsilon",
+               "planner", "window_stride"]
+
+
+def shard_name(map_index, shard_index):
+    return "map{:05d}_shard{:04d}".format(map_index, shard_index)
+
+
+def _save_array(file_name, array):
+    np.save(file_name, np.ascontiguousarray(array))
+
+
+class SampleRenderer(object):
+    '''
+    Renders `samples_per_map` samples of every map of `cfg.data.occu_map_dir` into `out_dir`.
+
+    Every shard holds up to `shard_size` samples of a single map and is stored as a directory of .npy files:
+        occupancy.npy        the uint8 occupancy crops, flattened and concatenated (crops may differ in size).
+        occupancy_index.npy  (n, 3) int64 offset, height and width of every crop in occupancy.npy.
+        depth.npy            (n, ...) float32 depth inputs.
+        state.npy            (n, ...) float32 states (int64 classes for the cnn protocol).
+        extent.npy           (n, 2) float64 world width and height of every crop.
+    A shard is complete once its <shard>.yaml file exists, so an interrupted run picks up where it stopped.
+    Every shard is rendered with its own seed, so the output does not depend on the number of workers.
+    '''
+
+    def __init__(self, cfg, out_dir, samples_per_map, shard_size=256, seed=0):
+        '''
+        :param cfg: the training/testing config, its data section defines the samples.
+        :param out_dir: directory of the sample store. Created if missing.
+        :param samples_per_map: number of samples rendered per map.
+        :param shard_size: max number of samples per shard.
+        :param seed: base seed of the per shard seeds.
+        '''
+        self.cfg = cfg
+        self.out_dir = out_dir
+        self.samples_per_map = samples_per_map
+        self.shard_size = shard_size
+        self.seed = seed
+        self.dataset = None
+
+        self.manifest = {"dataset": dataset.dataset_protocol[cfg.data.protocol].__name__,
+                         "mode": cfg.mode,
+                         "seed": seed,
+                         "samples_per_map": samples_per_map,
+                         "shard_size": shard_size,
+                         "data": {k: cfg.data.get(k, None) for k in render_keys},
+                         "occu_map_dir": cfg.data.occu_map_dir,
+                         "occu_map_paths": sorted(glob.glob(osp.join(cfg.data.occu_map_dir, '*'))),
+                         "complete": False,
+                         "shards": []}
+
+    def tasks(self):
+        '''
+        :return: a list of (map index, shard index, number of samples), one per shard.
+        '''
+        tasks = []
+        for map_index in range(len(self.manifest["occu_map_paths"])):
+            for shard_index, start in enumerate(range(0, self.samples_per_map, self.shard_size)):
+                tasks.append((map_index, shard_index, min(self.shard_size, self.samples_per_map - start)))
+        return tasks
+
+    def check_manifest(self, force=False):
+        '''
+        Write the manifest of a new store, or check that an existing store was rendered with the same settings.
+        '''
+        manifest_file = osp.join(self.out_dir, "manifest.yaml")
+        if osp.isfile(manifest_file) and not force:
+            old = yaml.load(open(manifest_file).read(), Loader=yaml.SafeLoader)
+            for k in ["dataset", "mode", "seed", "samples_per_map", "shard_size", "data", "occu_map_paths"]:
+                if old[k] != self.manifest[k]:
+                    raise ValueError("{} was rendered with a different {} ({} != {}), use --force to re-render".format(
+                        self.out_dir, k, old[k], self.manifest[k]))
+        elif osp.isdir(self.out_dir) and force:
+            shutil.rmtree(self.out_dir)
+        os.makedirs(self.out_dir, exist_ok=True)
+        yaml.safe_dump(self.manifest, open(manifest_file, "w"))
+
+    def render_shard(self, task):
+        map_index, shard_index, n = task
+        name = shard_name(map_index, shard_index)
+        shard_file = osp.join(self.out_dir, name + ".yaml")
+        if osp.isfile(shard_file):
+            return name, n, 0.0
+
+        s = time.time()
+        if self.dataset is None:
+            self.dataset = dataset.dataset_protocol[self.cfg.data.protocol](self.cfg)
+            ## the shards store the samples, compact or not when they are read back
+            self.dataset.compact_batch = False
+        ## per shard seed
+        shard_seed = np.random.SeedSequence([self.seed, map_index, shard_index]).generate_state(1)[0]
+        np.random.seed(shard_seed)
+        random.seed(int(shard_seed))
+
+        occu_map_path = self.manifest["occu_map_paths"][map_index]
+        occupancy, occupancy_index, depth, state, extent = [], [], [], [], []
+        offset = 0
+        for _ in range(n):
+            o, d, st, _, W_world, H_world = self.dataset.sample(occu_map_path)
+            o = o.numpy().astype(np.uint8).reshape(-1, o.shape[-1])
+            occupancy.append(o.ravel())
+            occupancy_index.append([offset, o.shape[0], o.shape[1]])
+            offset += o.size
+            depth.append(d.numpy())
+            state.append(st.numpy())
+            extent.append([W_world, H_world])
+
+        ## write to a temporary directory first, an interrupted shard is rendered again
+        tmp_dir = osp.join(self.out_dir, name + ".tmp")
+        if osp.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        _save_array(osp.join(tmp_dir, "occupancy.npy"), np.concatenate(occupancy))
+        _save_array(osp.join(tmp_dir, "occupancy_index.npy"), np.array(occupancy_index, dtype=np.int64))
+        _save_array(osp.join(tmp_dir, "depth.npy"), np.stack(depth))
+        _save_array(osp.join(tmp_dir, "state.npy"), np.stack(state))
+        _save_array(osp.join(tmp_dir, "extent.npy"), np.array(extent, dtype=np.float64))
+        if osp.isdir(osp.join(self.out_dir, name)):
+            shutil.rmtree(osp.join(self.out_dir, name))
+        os.replace(tmp_dir, osp.join(self.out_dir, name))
+        yaml.safe_dump({"map": map_index, "n": n}, open(shard_file + ".tmp", "w"))
+        os.replace(shard_file + ".tmp", shard_file)
+        return name, n, time.time() - s
+
+    def run(self, num_workers=1, force=False, verbose=True):
+        '''
+        Render all missing shards with `num_workers` processes and mark the manifest as complete.
+        '''
+        self.check_manifest(force)
+        tasks = self.tasks()
+        s = time.time()
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            results = pool.imap_unordered(self.render_shard, tasks)
+        else:
+            pool = None
+            results = map(self.render_shard, tasks)
+        for i, (name, n, t) in enumerate(results):
+            if verbose:
+                print("[{}/{}] {}: {} samples{}".format(
+                    i + 1, len(tasks), name, n, " in {:.1f}s".format(t) if t > 0 else " (done)"))
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        self.manifest["shards"] = [{"name": shard_name(m, i), "map": m, "n": n} for m, i, n in tasks]
+        self.manifest["complete"] = True
+        yaml.safe_dump(self.manifest, open(osp.join(self.out_dir, "manifest.yaml"), "w"))
+        if verbose:
+            print("rendered {} samples to {} in {:.1f}s".format(
+                sum([n for _, _, n in tasks]), self.out_dir, time.time() - s))
+
+
+class rendered_dataset(IterableDataset):
+    '''
+    Reads the samples rendered by `SampleRenderer` from `cfg.data.rendered_dir`.
+
+    Shards are memory mapped and samples are zero-copy views of them, the occupancy included (uint8, converted
+    to float by the model). In train mode the shard order is shuffled every epoch and the samples go through a
+    shuffle buffer of `cfg.data.shuffle_buffer` samples; in test mode they come in the rendered order.
+    Shards are split between the DataLoader workers. An epoch is the whole store, whatever data.samples_per_epoch.
+    With data.compact_batch the samples are compact ones (see
+    dataset.compact_collate), whose crop offsets are -1 as the shards do not store them.
+    '''
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.rendered_dir = cfg.data.rendered_dir
+        self.shuffle = cfg.mode == "train"
+        self.shuffle_buffer = cfg.data.get('shuffle_buffer', 1024) or 0
+
+        manifest_file = osp.join(self.rendered_dir, "manifest.yaml")
+        if not osp.isfile(manifest_file):
+            raise FileNotFoundError("no sample store in {}, render it with `python -m data.sample_store`".format(
+                self.rendered_dir))
+        self.manifest = yaml.load(open(manifest_file).read(), Loader=yaml.SafeLoader)
+        if not self.manifest["complete"]:
+            raise ValueError("the sample store in {} is incomplete, resume the rendering first".format(
+                self.rendered_dir))
+        if self.manifest["dataset"] != dataset.dataset_protocol[cfg.data.protocol].__name__:
+            raise ValueError("{} holds {} samples, {} needs {}".format(
+                self.rendered_dir, self.manifest["dataset"], cfg.data.protocol,
+                dataset.dataset_protocol[cfg.data.protocol].__name__))
+        ## the render settings fix the shapes of the samples, see SampleRenderer.check_manifest
+        for k in render_keys:
+            if self.manifest["data"].get(k, None) != cfg.data.get(k, None):
+                raise ValueError("{} was rendered with a different data.{} ({} != {}), render it again".format(
+                    self.rendered_dir, k, self.manifest["data"].get(k, None), cfg.data.get(k, None)))
+
+        self.occu_map_paths = self.manifest["occu_map_paths"]
+        self.compact_batch = cfg.data.get('compact_batch', False)
+        self.shards = self.manifest["shards"]
+        self.length = sum([shard["n"] for shard in self.shards])
+        ## epochs iterated by this copy of the dataset, persistent workers keep theirs across epochs
+        self.epoch = 0
+        self.map_source = None
+
+    def __len__(self):
+        return self.length
+
+    def load_map(self, occu_map_path):
+        ## maps are only needed for visualization
+        if self.map_source is None:
+            self.map_source = dataset.dataset_protocol[self.cfg.data.protocol](self.cfg)
+        return self.map_source.load_map(occu_map_path)
+
+    def load_shard(self, name):
+        '''
+        :return: dict of the memory mapped arrays of a shard. Copy-on-write, so torch can wrap them without copies.
+        '''
+        shard_dir = osp.join(self.rendered_dir, name)
+        return {k: np.load(osp.join(shard_dir, k + ".npy"), mmap_mode="c")
+                for k in ["occupancy", "occupancy_index", "depth", "state", "extent"]}
+
+    def get_sample(self, shard, map_index, i):
+        offset, h, w = shard["occupancy_index"][i]
+        occupancy = torch.from_numpy(shard["occupancy"][offset:offset + h * w]).view(1, h, w)
+        depth = torch.from_numpy(shard["depth"][i])
+        state = torch.from_numpy(shard["state"][i])
+        W_world, H_world = shard["extent"][i]
+        if self.compact_batch:
+            return occupancy, depth, state, map_index, np.array([W_world, H_world, W_world / w, -1, -1])
+        return occupancy, depth, state, self.occu_map_paths[map_index], float(W_world), float(H_world)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is None:
+            worker_id, num_workers = 0, 1
+            ## drawn from the torch generator so every epoch gets a new order
+            base_seed = int(torch.empty((), dtype=torch.int64).random_())
+        else:
+            worker_id, num_workers = worker.id, worker.num_workers
+            base_seed = worker.seed - worker.id
+
+        shards = list(self.shards)
+        if self.shuffle:
+            ## same shard order in every worker, so the split is a partition
+            np.random.RandomState([base_seed % 2**32, self.epoch]).shuffle(shards)
+        shards = shards[worker_id::num_workers]
+        rng = np.random.RandomState([(base_seed + worker_id) % 2**32, self.epoch])
+        self.epoch += 1
+
+        buffer = []
+        for shard_info in shards:
+            shard = self.load_shard(shard_info["name"])
+            order = rng.permutation(shard_info["n"]) if self.shuffle else range(shard_info["n"])
+            for i in order:
+                sample = self.get_sample(shard, shard_info["map"], i)
+                if not self.shuffle or self.shuffle_buffer <= 1:
+                    yield sample
+                elif len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                else:
+                    j = rng.randint(len(buffer))
+                    yield buffer[j]
+                    buffer[j] = sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render training samples into a sharded, memory-mapped store.")
+    parser.add_argument("--config", type=str, default="configs/cvae_train.yaml")
+    parser.add_argument("--out_dir", type=str, default=None, help="defaults to data.rendered_dir of the config")
+    parser.add_argument("--samples_per_map", type=int, default=1000)
+    parser.add_argument("--shard_size", type=int, default=256)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--force", action="store_true", help="delete the existing store and render it again")
+    args = parser.parse_args()
+
+    cfg = Config(args.config)
+    out_dir = args.out_dir or cfg.data.get('rendered_dir', None)
+    if out_dir is None:
+        parser.error("no --out_dir given and data.rendered_dir is not set in {}".format(args.config))
+    renderer = SampleRenderer(cfg, out_dir, args.samples_per_map, args.shard_size, args.seed)
+    renderer.run(args.num_workers, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -45,7 +45,8 @@ class basic_CNN(nn.Module):
         )
 
     def forward(self, x):
-        return self.backbone(x)
+        ## the datasets hand out uint8 occupancy maps (0 free, 255 obstacle), convert them on the device
+        return self.backbone(x.float())
 
 class Encoder(nn.Module):
 
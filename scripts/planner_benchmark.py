@@ -0,0 +1,146 @@
+"""Benchmark the grid planners of utils.utils on crops of the training maps, optionally against the sorted-list A*."""
+import argparse
+import glob
+import os.path as osp
+import time
+
+import numpy as np
+
+from utils.map_utils import Map
+from utils.utils import planner_protocol, MapEnvironment
+
+
+class LegacyAStarPlanner(object):
+    '''
+    The previous AStarPlanner: the open list is re-sorted after every expansion and holds whole paths. States are
+    checked one at a time by the per-state loop that MapEnvironment.state_validity_checker used before it was
+    vectorized, so the comparison does not depend on the current MapEnvironment. The baseline loop compared cells
+    to 1.0 and so never blocked the walls of the 0/255 occupancy grids; like the current MapEnvironment, this copy
+    blocks every non-zero cell, otherwise the two planners would not search the same graph.
+    '''
+
+    def __init__(self, planning_env, epsilon):
+        self.env = planning_env
+        self.epsilon = epsilon
+        self.visited = np.zeros(self.env.map.shape)
+
+    def state_validity_checker(self, config):
+        for i in range(config.shape[1]):
+            if config[0, i] < self.env.xlimit[0] or config[0, i] > self.env.xlimit[1]:
+                return False
+            if config[1, i] < self.env.ylimit[0] or config[1, i] > self.env.ylimit[1]:
+                return False
+            if self.env.map[int(config[1, i]), int(config[0, i])] != 0:
+                return False
+        return True
+
+    def Plan(self, start_config, goal_config):
+        q = [start_config]
+        c = [0]
+        a_c = [0]
+        while len(q) > 0:
+            current = q.pop(0)
+            _ = c.pop(0)
+            current_action_cost = a_c.pop(0)
+            last_x, last_y = current[:, -1]
+            if not self.visited[int(last_y), int(last_x)]:
+                self.visited[int(last_y), int(last_x)] = 1
+                if self.env.goal_criterion(np.array([[last_x], [last_y]]), goal_config):
+                    break
+                next_states = []
+                next_cost = []
+                for i in range(-1, 2):
+                    for j in range(-1, 2):
+                        if i == 0 and j == 0:
+                            continue
+                        next_states.append(np.array([[last_x + i], [last_y + j]]))
+                        next_cost.append(self.env.compute_distance(np.array([[last_x + i], [last_y + j]]),
+                                                                   np.array([[last_x], [last_y]])))
+                for i, state in enumerate(next_states):
+                    if self.state_validity_checker(state):
+                        q.append(np.hstack([current, state]))
+                        cost = current_action_cost + next_cost[i]
+                        a_c.append(cost)
+                        cost += self.epsilon * self.env.h(np.hstack([state, goal_config]))
+                        c.append(cost)
+                idx = sorted(range(len(c)), key=lambda k: c[k])
+                q = [q[idy] for idy in idx]
+                c = [c[idy] for idy in idx]
+                a_c = [a_c[idy] for idy in idx]
+        plan = current.tolist()
+
+        return np.array(plan)
+
+
+def path_cost(plan):
+    '''
+    :param plan: a [2 x n] numpy array of cells.
+    :return: the length of the path through the cells.
+    '''
+    return np.sqrt((np.diff(plan.astype(float), axis=1) ** 2).sum(0)).sum()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Grid planner benchmark, and parity check of A* against its legacy version.")
+    parser.add_argument("--map_dir", type=str, default="data/maps_train")
+    parser.add_argument("--max_maps", type=int, default=10)
+    parser.add_argument("--planners", type=str, nargs="+", default=list(planner_protocol.keys()))
+    parser.add_argument("--n_pair", type=int, default=5, help="start/goal pairs per map")
+    parser.add_argument("--downsample_factor", type=int, default=4)
+    parser.add_argument("--crop_size", type=int, default=256)
+    parser.add_argument("--epsilon", type=float, default=10, help="heuristic weight, as in seq_cvae_dataset")
+    parser.add_argument("--goal_tolerance", type=float, default=0.1, help="data.epsilon of the seq configs")
+    parser.add_argument("--legacy", action="store_true", help="also run the sorted-list A* and compare its plans")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    config_files = sorted(glob.glob(osp.join(args.map_dir, "*", "floorplan.yaml")))[:args.max_maps]
+    names = args.planners + (["legacy"] if args.legacy else [])
+
+    times = {name: [] for name in names}
+    expanded = {name: [] for name in names}
+    lengths = {name: [] for name in names}
+    mismatches, cost_mismatches, unreachable = 0, 0, 0
+    for config_file in config_files:
+        m = Map(config_file, downsample_factor=args.downsample_factor,
+                crop_size=args.crop_size if args.crop_size > 0 else None)
+        occupancy = m.get_occupancy_grid()
+        for start, goal in m.sample_free_positions(2 * args.n_pair).reshape(args.n_pair, 2, 2):
+            start_config = np.array([m.grid_coord(*start)]).T
+            goal_config = np.array([m.grid_coord(*goal)]).T
+            env = MapEnvironment(occupancy, start_config, goal_config, args.goal_tolerance)
+
+            plans = {}
+            for name in names:
+                planner = LegacyAStarPlanner(env, args.epsilon) if name == "legacy" else \
+                    planner_protocol[name](env, args.epsilon)
+                s = time.time()
+                plans[name] = planner.Plan(start_config, goal_config)
+                times[name].append(time.time() - s)
+                expanded[name].append(getattr(planner, "expanded", np.nan))
+                lengths[name].append(plans[name].shape[1])
+            ## when the goal is not reachable the planners return a path to the last expanded cell, which may differ
+            reached = np.array_equal(plans[names[0]][:, -1:], goal_config)
+            unreachable += not reached
+            if args.legacy and "astar" in plans:
+                mismatches += reached and not np.array_equal(plans["astar"], plans["legacy"])
+                cost_mismatches += reached and not np.isclose(path_cost(plans["astar"]), path_cost(plans["legacy"]))
+        print("{}: {}".format(osp.basename(osp.dirname(config_file)), ", ".join(
+            ["{} {:.1f}ms / {:.0f} expansions".format(name, 1000 * np.mean(times[name][-args.n_pair:]),
+                                                      np.mean(expanded[name][-args.n_pair:])) for name in names])))
+
+    print("{} plans, {} unreachable goals".format(len(times[names[0]]), unreachable))
+    print("planner, time per plan (ms), max time (ms), expansions per plan, path length (cells)")
+    for name in names:
+        print("{}, {:.2f}, {:.1f}, {:.0f}, {:.1f}".format(
+            name, 1000 * np.mean(times[name]), 1000 * np.max(times[name]), np.mean(expanded[name]),
+            np.mean(lengths[name])))
+    if args.legacy and "astar" in names:
+        print("astar vs legacy: speedup {:.1f}x, {} plans to reached goals with a different cost, {} with different "
+              "cells".format(np.sum(times["legacy"]) / np.sum(times["astar"]), cost_mismatches, mismatches))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Compare the raycasting backends of utils.map_utils.Map against the fixed-step march.
+
+With --check, the DDA backend is instead checked against the march on a synthetic map and the script exits with a
+nonzero status if the parity check fails.
+"""
+import argparse
+import glob
+import os.path as osp
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from utils.map_cache import MapLRUCache
+from utils.map_utils import Map
+
+
+def make_synthetic_map(directory, size=64, resolution=0.25, seed=0):
+    '''
+    Write a synthetic floorplan: a walled room split by axis-aligned walls with doorways, a one-cell wide diagonal
+    wall and a few random blocks. The resolution is a power of two so that cell boundaries are exact floats.
+    :return: the path of the .yaml file of the map.
+    '''
+    rng = np.random.RandomState(seed)
+    free = np.full((size, size), 255, dtype=np.uint8)
+    free[[0, -1], :] = 0
+    free[:, [0, -1]] = 0
+    free[size // 2, :] = 0
+    free[size // 2, size // 4:size // 4 + 4] = 255
+    free[:size // 2, size // 3] = 0
+    free[size // 8:size // 8 + 4, size // 3] = 255
+    for i in range(size // 4):
+        free[size // 2 + 4 + i, size // 2 + i] = 0
+    for _ in range(8):
+        y, x = rng.randint(2, size - 6, size=2)
+        free[y:y + rng.randint(1, 4), x:x + rng.randint(1, 4)] = 0
+
+    cv2.imwrite(osp.join(directory, "floorplan.png"), free)
+    config_file = osp.join(directory, "floorplan.yaml")
+    with open(config_file, "w") as f:
+        f.write("image: floorplan.png\norigin:\n- 0\n- 0\nresolution: {}\n".format(resolution))
+    return config_file
+
+
+def check_parity(args):
+    '''
+    Parity of the DDA backend with the march on a synthetic map. The march samples every half cell, so rays from
+    cell centers sample the cell boundaries themselves:
+    - no DDA depth is larger than the march depth plus one march step,
+    - on axis-aligned rays from cell centers, both backends return the same depths. A sample on a boundary
+      belongs to the cell after it, so along -x and -y the march reads the obstacle one step later: there its
+      depth must be exactly the DDA depth plus one step (up to the maximum depth),
+    - at least `args.min_within_step` of the random rays are within one march step of the march.
+    :return: a list of failure messages, empty if the check passed.
+    '''
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        m = Map(make_synthetic_map(directory), laser_max_range=args.laser_max_range)
+    step = m.resolution / 2
+
+    poses = m.sample_free_positions(args.n_pose)
+    headings = np.random.uniform(0, 2 * np.pi, args.n_pose)
+    fov = np.deg2rad(args.fov)
+    march = m.get_1d_depth_batch(poses, headings, fov, args.n_ray, resolution=step, method="march")
+    dda = m.get_1d_depth_batch(poses, headings, fov, args.n_ray, resolution=step, method="dda")
+    excess = dda - march
+    if excess.max() > step + 1e-9:
+        failures.append("DDA depth exceeds the march depth by {:.4f}m (> one step of {}m)".format(
+            excess.max(), step))
+    within_step = np.mean(np.abs(excess) <= step + 1e-9)
+    if within_step < args.min_within_step:
+        failures.append("only {:.2f}% of the rays are within one step of the march (< {:.2f}%)".format(
+            100 * within_step, 100 * args.min_within_step))
+
+    ## every free cell center, four rays along -x, -y, +x and +y
+    free_rows, free_cols = np.nonzero(m.occupancy_grid == 0)
+    centers = np.stack([free_cols + 0.5, free_rows + 0.5], axis=1) / m.n_division + np.array(m.origin[:2])
+    headings = np.zeros(len(centers))
+    march = m.get_1d_depth_batch(centers, headings, 2 * np.pi, 4, resolution=step, method="march")
+    dda = m.get_1d_depth_batch(centers, headings, 2 * np.pi, 4, resolution=step, method="dda")
+    max_depth = (int(args.laser_max_range / step) - 1) * step
+    expected = dda.copy()
+    expected[:, :2] = np.minimum(dda[:, :2] + step, max_depth)
+    n_mismatch = np.sum(np.abs(expected - march) > 1e-9)
+    if n_mismatch > 0:
+        failures.append("{} of {} axis-aligned rays differ between DDA and the march".format(
+            n_mismatch, march.size))
+
+    print("parity check: DDA - march in [{:.4f}, {:.4f}]m, {:.2f}% of the rays within one step, "
+          "{} axis-aligned mismatches".format(excess.min(), excess.max(), 100 * within_step, n_mismatch))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Raycasting parity check and benchmark.")
+    parser.add_argument("--map_dir", type=str, default="data/maps_train")
+    parser.add_argument("--max_maps", type=int, default=10)
+    parser.add_argument("--methods", type=str, nargs="+", default=list(Map.raycast_methods))
+    parser.add_argument("--n_pose", type=int, default=200)
+    parser.add_argument("--downsample_factor", type=int, default=4)
+    parser.add_argument("--crop_size", type=int, default=256)
+    parser.add_argument("--laser_max_range", type=float, default=4)
+    parser.add_argument("--resolution", type=float, default=None,
+                        help="step of the march (defaults to the map resolution)")
+    parser.add_argument("--n_ray", type=int, default=100)
+    parser.add_argument("--fov", type=float, default=240)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true",
+                        help="check the DDA backend against the march on a synthetic map instead of benchmarking")
+    parser.add_argument("--min_within_step", type=float, default=0.95,
+                        help="smallest fraction of the rays within one march step of the march with --check")
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    if args.check:
+        failures = check_parity(args)
+        for failure in failures:
+            print("FAILED: " + failure)
+        sys.exit(1 if failures else 0)
+
+    fov = np.deg2rad(args.fov)
+    config_files = sorted(glob.glob(osp.join(args.map_dir, "*", "floorplan.yaml")))[:args.max_maps]
+
+    times = {method: [] for method in args.methods}
+    setup_times = {method: [] for method in args.methods}
+    errors = {method: [] for method in args.methods}
+    ## the lut backend needs a store caching its tables
+    store = MapLRUCache(max_entries=8) if "lut" in args.methods else None
+    for config_file in config_files:
+        m = Map(config_file, laser_max_range=args.laser_max_range, downsample_factor=args.downsample_factor,
+                crop_size=args.crop_size if args.crop_size > 0 else None, store=store)
+        poses = m.sample_free_positions(args.n_pose)
+        headings = np.random.uniform(0, 2 * np.pi, args.n_pose)
+        reference = m.get_1d_depth_batch(poses, headings, fov, args.n_ray, resolution=args.resolution,
+                                         method="march")
+
+        line = [osp.basename(osp.dirname(config_file))]
+        for method in args.methods:
+            # the first call builds the distance field / table of the backend, if any
+            s = time.time()
+            m.get_1d_depth(poses[0], headings[0], fov, args.n_ray, resolution=args.resolution, method=method)
+            setup_times[method].append(time.time() - s)
+
+            s = time.time()
+            for pose, heading in zip(poses, headings):
+                m.get_1d_depth(pose, heading, fov, args.n_ray, resolution=args.resolution, method=method)
+            times[method].append((time.time() - s) / args.n_pose)
+
+            depth = m.get_1d_depth_batch(poses, headings, fov, args.n_ray, resolution=args.resolution,
+                                         method=method)
+            errors[method].append(np.abs(depth - reference).ravel())
+            line.append("{}: {:.2f}ms".format(method, times[method][-1] * 1000))
+        print(", ".join(line))
+
+    step = args.resolution if args.resolution is not None else m.resolution
+    print("method, setup per map (ms), time per scan (ms), mean |depth - march| (m), "
+          "rays within one march step of the march")
+    for method in args.methods:
+        error = np.concatenate(errors[method])
+        print("{}, {:.1f}, {:.3f}, {:.4f}, {:.2f}%".format(
+            method, np.mean(setup_times[method]) * 1000, np.mean(times[method]) * 1000, error.mean(),
+            100 * np.mean(error <= step + 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Smoke check of the tester on a pre-rendered sample store (data.rendered_dir) with visualization on.
+
+Renders a small store from synthetic maps into a temporary directory, saves an untrained CVAE checkpoint and runs
+scripts.tester.Tester_cvae on the store with `vis` and the heatmaps enabled, like configs/*_test.yaml. Exits with a
+nonzero status if the tester fails or does not write the visualizations.
+"""
+import argparse
+import os
+import os.path as osp
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+from data.sample_store import SampleRenderer
+from network import network
+from scripts.raycast_benchmark import make_synthetic_map
+from scripts.tester import Tester_cvae
+from utils.config import AttrDict
+
+
+def make_config(directory, args):
+    '''
+    A cvae test config reading the samples of `directory`/store, see configs/cvae_test.yaml.
+    '''
+    return AttrDict({
+        "mode": "test",
+        "exp_prefix": "cvae",
+        "base_dir": directory,
+        "checkpoint_dir": osp.join(directory, "checkpoints"),
+        "checkpoint_file": "best_model",
+        "vis": True,
+        "heatmap": {"gen": True, "num_data": 16},
+        "framework": {"seed": args.seed, "num_thread": 0, "num_gpu": 0},
+        "model": {"protocol": "cvae", "latent_z_dim": 16, "hidden_dim": 16, "activation_func": "tanh"},
+        "data": {"protocol": "cvae",
+                 "input_depth_dim": 2 * args.n_ray,
+                 "input_state_dim": 3,
+                 "input_occumap_dim": [1, 64, 64],
+                 "batch_size": args.batch_size,
+                 "crop_size": 0,
+                 "downsample_factor": 1,
+                 "laser_max_range": 4,
+                 "n_ray": args.n_ray,
+                 "fov": 240,
+                 "occu_map_dir": osp.join(directory, "maps"),
+                 "world_coord_laser": True,
+                 "rendered_dir": osp.join(directory, "store")},
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the tester on a pre-rendered sample store with vis on.")
+    parser.add_argument("--n_map", type=int, default=2)
+    parser.add_argument("--samples_per_map", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=1, help="the test configs use 1")
+    parser.add_argument("--n_ray", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        cfg = make_config(directory, args)
+        for i in range(args.n_map):
+            map_dir = osp.join(cfg.data.occu_map_dir, "synthetic{}".format(i))
+            os.makedirs(map_dir)
+            make_synthetic_map(map_dir, seed=i)
+        SampleRenderer(cfg, cfg.data.rendered_dir, args.samples_per_map, seed=args.seed).run(verbose=False)
+
+        ## an untrained model is enough to go through the visualization
+        os.makedirs(cfg.checkpoint_dir)
+        torch.save({"parameters": network.CVAE(cfg).state_dict()},
+                   "{}/{}.pt".format(cfg.checkpoint_dir, cfg.checkpoint_file))
+        Tester_cvae(cfg).run()
+
+        n_samples = args.n_map * args.samples_per_map
+        vis_dir = osp.join(directory, "vis")
+        missing = [name for i in range(n_samples) for name in ["{:03d}.png".format(i + 1),
+                                                                "heatmap_{:03d}.png".format(i + 1)]
+                   if not osp.isfile(osp.join(vis_dir, name))]
+    if missing:
+        print("FAILED: the tester did not write {}".format(", ".join(missing)))
+        sys.exit(1)
+    print("tester on a rendered store: {} samples visualized".format(n_samples))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ from network import network
 from data import dataset
 import cv2, json
 import matplotlib.pyplot as plt
-from utils.map_utils import Visualizer, Map
+from utils.map_utils import Visualizer
 import glob, os, os.path as osp
 import math
 from utils.utils import fig2img
@@ -19,23 +19,16 @@ model_protocol = {"cvae": network.CVAE,
                   "cls": network.Classfication_model,
                   "reg": network.Regression_model,
                   "seq_cvae": network.SeqCVAE,}
-dataset_protocol = {"cvae": dataset.cvae_dataset,
-                    "cnn": dataset.cnn_dataset,
-                    "cls": dataset.cvae_dataset,
-                    "reg": dataset.cvae_dataset,
-                    "seq_cvae": dataset.seq_cvae_dataset,}
 
 
 class Tester:
     def __init__(self, config):
         ### somethings
         self.cfg = config
-        self.dataset = dataset_protocol[config.data.protocol](config)
-        self.dataloader = torch.utils.data.DataLoader(
-            self.dataset,
-            batch_size=config.data.batch_size,
-            num_workers=config.framework.num_thread,
-        )
+        self.dataset = dataset.build_dataset(config)
+        self.dataloader = dataset.build_dataloader(config, self.dataset)
+        ## batches are moved to the GPU by dataset.unpack_batch
+        self.device = 0 if config.framework.num_gpu > 0 else None
         widgets = [
             "Testing phase [",
             progressbar.SimpleProgress(),
@@ -87,15 +80,7 @@ class Tester:
         for idy in range(len(state)):
             # get occu map
             occu_map_path = occu_map_path_batch[idy]
-            if self.dataset.crop_size == 0:
-                m = Map(osp.join(occu_map_path, 'floorplan.yaml'),
-                        laser_max_range=self.dataset.laser_max_range,
-                        downsample_factor=self.dataset.downsample_factor)
-            else:
-                m = Map(osp.join(occu_map_path, 'floorplan.yaml'),
-                        laser_max_range=self.dataset.laser_max_range,
-                        downsample_factor=self.dataset.downsample_factor,
-                        crop_size=self.dataset.crop_size)
+            m = self.dataset.load_map(occu_map_path)
 
             # allocate visualizer object with matplotlib and occu map
             fig, ax = plt.subplots()
@@ -186,15 +171,7 @@ class Tester:
         for idy in range(len(state)):
             # get occu map
             occu_map_path = occu_map_path_batch[idy]
-            if self.dataset.crop_size == 0:
-                m = Map(osp.join(occu_map_path, 'floorplan.yaml'),
-                        laser_max_range=self.dataset.laser_max_range,
-                        downsample_factor=self.dataset.downsample_factor)
-            else:
-                m = Map(osp.join(occu_map_path, 'floorplan.yaml'),
-                        laser_max_range=self.dataset.laser_max_range,
-                        downsample_factor=self.dataset.downsample_factor,
-                        crop_size=self.dataset.crop_size)
+            m = self.dataset.load_map(occu_map_path)
 
             # allocate visualizer object with matplotlib and occu map
             fig, ax = plt.subplots()
@@ -291,14 +268,9 @@ class Tester_cvae(Tester):
 
     def run(self):
         recon_losses, l2_all, angle_diff_all, valid_all = [], [], [], []
-        for idx, (occupancy, depth, state, occu_map_path_batch, W_world, H_world) in enumerate(self.dataloader):
-            
-            if self.cfg.framework.num_gpu > 0:
-                occupancy, depth, state = (
-                    occupancy.to(device=0),
-                    depth.to(device=0),
-                    state.to(device=0),
-                )
+        for idx, batch in enumerate(self.dataloader):
+            occupancy, depth, state, occu_map_path_batch, W_world, H_world = dataset.unpack_batch(
+                batch, self.dataset.occu_map_paths, self.device)
 
             # forward
             with torch.no_grad():
@@ -358,17 +330,10 @@ class Tester_cls(Tester):
 
     def run(self):
         losses, total_correct, l2_all, angle_diff_all, valid_all = [], [], [], [], []
-        for idx, (occupancy, depth, state, occu_map_path_batch, W_world, H_world) in enumerate(self.dataloader):
-
-            if self.cfg.framework.num_gpu > 0:
-                occupancy, depth, state, W_world, H_world, ones = (
-                    occupancy.to(device=0),
-                    depth.to(device=0),
-                    state.to(device=0),
-                    W_world.to(device=0),
-                    H_world.to(device=0),
-                    torch.ones(1, dtype=torch.float64).to(device=0)
-                )
+        for idx, batch in enumerate(self.dataloader):
+            occupancy, depth, state, occu_map_path_batch, W_world, H_world = dataset.unpack_batch(
+                batch, self.dataset.occu_map_paths, self.device)
+            ones = torch.ones(1, dtype=torch.float64, device=W_world.device)
 
             # convert state to classes
             world_pos_x_cls = ((state[:, 0] * W_world) // (W_world / self.cfg.data.num_bin)).unsqueeze(1)
@@ -432,14 +397,9 @@ class Tester_reg(Tester_cvae):
 
     def run(self):
         recon_losses, l2_all, angle_diff_all, valid_all = [], [], [], []
-        for idx, (occupancy, depth, state, occu_map_path_batch, W_world, H_world) in enumerate(self.dataloader):
-
-            if self.cfg.framework.num_gpu > 0:
-                occupancy, depth, state = (
-                    occupancy.to(device=0),
-                    depth.to(device=0),
-                    state.to(device=0),
-                )
+        for idx, batch in enumerate(self.dataloader):
+            occupancy, depth, state, occu_map_path_batch, W_world, H_world = dataset.unpack_batch(
+                batch, self.dataset.occu_map_paths, self.device)
 
             # forward
             with torch.no_grad():
@@ -13,24 +13,16 @@ model_protocol = {"cvae": network.CVAE,
                   "reg": network.Regression_model,
                   "seq_cvae": network.SeqCVAE,}
 
-dataset_protocol = {"cvae": dataset.cvae_dataset,
-                    "cnn": dataset.cnn_dataset,
-                    "cls": dataset.cvae_dataset,
-                    "reg": dataset.cvae_dataset,
-                    "seq_cvae": dataset.seq_cvae_dataset,}
-
 
 class Trainer:
     def __init__(self, config):
 
         ### somethings
         self.cfg = config
-        self.dataset = dataset_protocol[config.data.protocol](config)
-        self.dataloader = torch.utils.data.DataLoader(
-            self.dataset,
-            batch_size=config.data.batch_size,
-            num_workers=config.framework.num_thread,
-        )
+        self.dataset = dataset.build_dataset(config)
+        self.dataloader = dataset.build_dataloader(config, self.dataset)
+        ## batches are moved to the GPU by dataset.unpack_batch
+        self.device = 0 if config.framework.num_gpu > 0 else None
         widgets = [
             "Training phase [",
             progressbar.SimpleProgress(),
@@ -83,6 +75,12 @@ class Trainer:
         )
         model.load_state_dict(sd["parameters"])
 
+    def log_map_store(self, epoch):
+        ## hit rates of the map cache of every worker, to size data.map_lru_entries / data.map_lru_bytes
+        for worker, stats in enumerate(dataset.map_store_stats(self.dataset)):
+            for k, v in stats.items():
+                self.logger.add_scalar("{}/map_store/worker{}/{}".format(self.cfg.mode, worker, k), v, epoch)
+
     def run(self):
         raise NotImplementedError
 
@@ -105,13 +103,9 @@ class Trainer_cvae(Trainer):
     def run(self):
         losses = []
         for epoch in range(1, self.cfg.train.num_epoch + 1):
-            for idx, (occupancy, depth, state, _, _, _) in enumerate(self.dataloader):
-                if self.cfg.framework.num_gpu > 0:
-                    occupancy, depth, state = (
-                        occupancy.to(device=0),
-                        depth.to(device=0),
-                        state.to(device=0),
-                    )
+            for idx, batch in enumerate(self.dataloader):
+                occupancy, depth, state, _, _, _ = dataset.unpack_batch(
+                    batch, self.dataset.occu_map_paths, self.device)
 
                 # forward
                 recon_state, means, log_var, z = self.model(state, occupancy, depth)
@@ -139,6 +133,7 @@ class Trainer_cvae(Trainer):
 
             if epoch % self.cfg.train.save_iter == 0:
                 self.save_checkpoints(losses)
+            self.log_map_store(epoch)
             self.scheduler.step()
             self.bar.update(epoch)
         print("finish!")
@@ -156,16 +151,10 @@ class Trainer_cls(Trainer):
     def run(self):
         losses = []
         for epoch in range(1, self.cfg.train.num_epoch + 1):
-            for idx, (occupancy, depth, state, _, W_world, H_world) in enumerate(self.dataloader):
-                if self.cfg.framework.num_gpu > 0:
-                    occupancy, depth, state, W_world, H_world, ones = (
-                        occupancy.to(device=0),
-                        depth.to(device=0),
-                        state.to(device=0),
-                        W_world.to(device=0),
-                        H_world.to(device=0),
-                        torch.ones(1, dtype=torch.float64).to(device=0)
-                    )
+            for idx, batch in enumerate(self.dataloader):
+                occupancy, depth, state, _, W_world, H_world = dataset.unpack_batch(
+                    batch, self.dataset.occu_map_paths, self.device)
+                ones = torch.ones(1, dtype=torch.float64, device=W_world.device)
 
                 # convert state to classes
                 world_pos_x_cls = ((state[:,0] * W_world) // (W_world / self.cfg.data.num_bin)).unsqueeze(1)
@@ -199,6 +188,7 @@ class Trainer_cls(Trainer):
 
             if epoch % self.cfg.train.save_iter == 0:
                 self.save_checkpoints(losses)
+            self.log_map_store(epoch)
             self.scheduler.step()
             self.bar.update(epoch)
         print("finish!")
@@ -216,13 +206,9 @@ class Trainer_reg(Trainer):
     def run(self):
         losses = []
         for epoch in range(1, self.cfg.train.num_epoch + 1):
-            for idx, (occupancy, depth, state, _, _, _) in enumerate(self.dataloader):
-                if self.cfg.framework.num_gpu > 0:
-                    occupancy, depth, state = (
-                        occupancy.to(device=0),
-                        depth.to(device=0),
-                        state.to(device=0),
-                    )
+            for idx, batch in enumerate(self.dataloader):
+                occupancy, depth, state, _, _, _ = dataset.unpack_batch(
+                    batch, self.dataset.occu_map_paths, self.device)
 
                 # forward
                 recon_state = self.model(occupancy, depth)
@@ -250,6 +236,7 @@ class Trainer_reg(Trainer):
 
             if epoch % self.cfg.train.save_iter == 0:
                 self.save_checkpoints(losses)
+            self.log_map_store(epoch)
             self.scheduler.step()
             self.bar.update(epoch)
         print("finish!")
@@ -0,0 +1,542 @@
+"""on-disk, in-process and shared-memory stores of decoded, downsampled occupancy grids."""
+import argparse
+import atexit
+import functools
+import glob
+import hashlib
+import os
+import os.path as osp
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import yaml
+
+from utils.map_utils import load_floorplan, pack_occupancy, unpack_occupancy, compute_distance_field, \
+    compute_free_index, compute_directional_distances
+
+
+def _window(index, shape):
+    ## (first row, end row, first column, end column) of a window given by two unit-step slices
+    rows, cols = index
+    r0, r1, row_step = rows.indices(shape[0])
+    c0, c1, col_step = cols.indices(shape[1])
+    if row_step != 1 or col_step != 1:
+        raise IndexError("only unit-step slices of stored grids are supported")
+    return r0, max(r0, r1), c0, max(c0, c1)
+
+
+def tile_grid(grid, tile_size, fill_value=255):
+    '''
+    Cut a 2D grid into square tiles, padding the last row and column of tiles with `fill_value`.
+    :return: a contiguous (n_tile_rows, n_tile_cols, tile_size, tile_size) array.
+    '''
+    h, w = grid.shape
+    t = tile_size
+    padded = np.full((-(-h // t) * t, -(-w // t) * t), fill_value, dtype=grid.dtype)
+    padded[:h, :w] = grid
+    return np.ascontiguousarray(padded.reshape(padded.shape[0] // t, t, padded.shape[1] // t, t).transpose(0, 2, 1, 3))
+
+
+class TiledGrid(object):
+    '''
+    Read-only 2D grid stored as square tiles (see tile_grid), typically memory mapped: reading a window only
+    touches the tiles it overlaps, so its cost is proportional to the window and not to the whole grid.
+    Supports `shape`, `dtype`, `size`, `nbytes`, slicing with two unit-step slices (which returns a new array) and
+    np.asarray (which assembles the whole grid).
+    '''
+
+    def __init__(self, tiles, shape):
+        '''
+        :param tiles: the (n_tile_rows, n_tile_cols, tile_size, tile_size) tiles.
+        :param shape: (height, width) of the grid.
+        '''
+        self.tiles = tiles
+        self.shape = tuple(shape)
+        self.dtype = tiles.dtype
+        self.tile_size = tiles.shape[2]
+
+    @property
+    def nbytes(self):
+        return self.tiles.nbytes
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    def __getitem__(self, index):
+        r0, r1, c0, c1 = _window(index, self.shape)
+        t = self.tile_size
+        ## tiles overlapped by the window
+        tr0, tc0 = r0 // t, c0 // t
+        tr1, tc1 = max(-(-r1 // t), tr0 + 1), max(-(-c1 // t), tc0 + 1)
+        block = self.tiles[tr0:tr1, tc0:tc1]
+        block = block.transpose(0, 2, 1, 3).reshape(block.shape[0] * t, block.shape[1] * t)
+        return block[r0 - tr0 * t:r1 - tr0 * t, c0 - tc0 * t:c1 - tc0 * t]
+
+    def __array__(self, dtype=None, copy=None):
+        grid = self[:, :]
+        return grid if dtype is None else grid.astype(dtype)
+
+
+class PackedGrid(object):
+    '''
+    Read-only occupancy grid stored with one bit per cell, set for obstacles: 8x smaller than the uint8 grid
+    of `load_floorplan`, whose cells are either 0 or 255. Reading a window only unpacks the bytes of that window,
+    and gives back the uint8 0/255 cells. Supports the same operations as TiledGrid.
+    '''
+
+    def __init__(self, bits, shape):
+        '''
+        :param bits: the (height, ceil(width / 8)) uint8 array of np.packbits(grid != 0, axis=1).
+        :param shape: (height, width) of the grid.
+        '''
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.uint8)
+
+    @classmethod
+    def pack(cls, grid):
+        return cls(pack_occupancy(grid), np.shape(grid))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    def __getitem__(self, index):
+        r0, r1, c0, c1 = _window(index, self.shape)
+        b0 = c0 // 8
+        return unpack_occupancy(self.bits[r0:r1, b0:-(-c1 // 8)], c1 - 8 * b0)[:, c0 - 8 * b0:]
+
+    def __array__(self, dtype=None, copy=None):
+        grid = self[:, :]
+        return grid if dtype is None else grid.astype(dtype)
+
+
+class MapDiskCache(object):
+    '''
+    Persistent cache of occupancy grids produced by `load_floorplan`.
+
+    Every entry is stored as two files in `cache_dir`:
+        <name>.npy   the downsampled uint8 occupancy grid (0 free, 255 obstacle), memory-mappable.
+        <name>.yaml  origin, resolution and shape of the grid.
+    Grids derived from the occupancy grid (see `get_field`) are stored next to it as <name>_<field>.npy.
+    With a `tile_size`, the occupancy grid is also stored as tiles in <name>_tiles<tile_size>.npy and `get` returns a
+    memory-mapped TiledGrid, so random crops of large maps only read the tiles they overlap.
+    The entry name is derived from the absolute floorplan path, the modification times of the floorplan
+    .yaml and image, and the downsample factor, so editing a map automatically invalidates its entries.
+    '''
+
+    def __init__(self, cache_dir, mmap=True, tile_size=None):
+        '''
+        :param cache_dir: directory holding the cache entries. Created if missing.
+        :param mmap: if True, grids are returned as read-only memory maps instead of being read into memory.
+        :param tile_size: if not None, occupancy grids are returned as TiledGrid of tiles of this size.
+        '''
+        self.cache_dir = cache_dir
+        self.mmap = mmap
+        self.tile_size = tile_size
+        if not osp.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _prefix(self, config_file, downsample_factor):
+        path = osp.abspath(config_file)
+        name = osp.basename(osp.dirname(path))
+        path_hash = hashlib.sha1(path.encode()).hexdigest()[:10]
+        return "{}_{}_ds{}".format(name, path_hash, downsample_factor)
+
+    def entry_name(self, config_file, downsample_factor):
+        '''
+        :return: the cache entry name of a floorplan. Changes whenever the floorplan files are modified.
+        '''
+        cfg = yaml.load(open(config_file).read(), Loader=yaml.SafeLoader)
+        img_file = osp.join(osp.dirname(osp.abspath(config_file)), cfg['image'])
+        stamp = "{}:{}".format(os.stat(config_file).st_mtime_ns, os.stat(img_file).st_mtime_ns)
+        stamp_hash = hashlib.sha1(stamp.encode()).hexdigest()[:10]
+        return "{}_{}".format(self._prefix(config_file, downsample_factor), stamp_hash)
+
+    def build(self, config_file, downsample_factor=1, force=False):
+        '''
+        Decode a floorplan and write it to the cache.
+        :param force: rebuild the entry even if it is up to date.
+        :return: the entry name.
+        '''
+        name = self.entry_name(config_file, downsample_factor)
+        grid_file = osp.join(self.cache_dir, name + ".npy")
+        meta_file = osp.join(self.cache_dir, name + ".yaml")
+        if not force and osp.exists(grid_file) and osp.exists(meta_file):
+            return name
+
+        occupancy_grid, origin, resolution = load_floorplan(config_file, downsample_factor)
+        meta = {
+            "config_file": osp.abspath(config_file),
+            "downsample_factor": int(downsample_factor),
+            "origin": [float(v) for v in origin],
+            "resolution": float(resolution),
+            "shape": [int(v) for v in occupancy_grid.shape],
+        }
+
+        # write to temporary files first so that concurrent readers never see partial entries
+        tmp_suffix = ".{}.{}.tmp".format(os.getpid(), threading.get_ident())
+        with open(meta_file + tmp_suffix, "w") as f:
+            yaml.safe_dump(meta, f)
+        self._save_array(grid_file, np.ascontiguousarray(occupancy_grid, dtype=np.uint8))
+        os.replace(meta_file + tmp_suffix, meta_file)
+
+        self._remove_stale(config_file, downsample_factor, name)
+        return name
+
+    def _save_array(self, file_name, array):
+        tmp_file = "{}.{}.{}.tmp".format(file_name, os.getpid(), threading.get_ident())
+        with open(tmp_file, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_file, file_name)
+
+    def _remove_stale(self, config_file, downsample_factor, name):
+        prefix = self._prefix(config_file, downsample_factor)
+        for f in glob.glob(osp.join(self.cache_dir, prefix + "_*")):
+            if not osp.basename(f).startswith(name):
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    def get(self, config_file, downsample_factor=1):
+        '''
+        :return: a tuple (occupancy_grid, origin, resolution) like `load_floorplan`. The entry is (re)built
+                 if it is missing or stale.
+        '''
+        name = self.build(config_file, downsample_factor)
+        with open(osp.join(self.cache_dir, name + ".yaml")) as f:
+            meta = yaml.safe_load(f)
+        if self.tile_size:
+            occupancy_grid = TiledGrid(self.get_tiles(name), meta["shape"])
+        else:
+            occupancy_grid = np.load(osp.join(self.cache_dir, name + ".npy"), mmap_mode="r" if self.mmap else None)
+        return occupancy_grid, np.array(meta["origin"]), meta["resolution"]
+
+    def get_tiles(self, name):
+        '''
+        :return: the tiles of the occupancy grid of entry `name` (see tile_grid), built on first use.
+        '''
+        tiles_file = osp.join(self.cache_dir, "{}_tiles{}.npy".format(name, self.tile_size))
+        if not osp.exists(tiles_file):
+            self._save_array(tiles_file, tile_grid(np.load(osp.join(self.cache_dir, name + ".npy")), self.tile_size))
+        return np.load(tiles_file, mmap_mode="r" if self.mmap else None)
+
+    def get_field(self, config_file, downsample_factor, field, build_fn):
+        '''
+        Get a grid derived from the full occupancy grid, e.g. its distance field. It is computed with
+        `build_fn(occupancy_grid)` on first use and cached with the entry, so it is invalidated together with it.
+        '''
+        name = self.build(config_file, downsample_factor)
+        field_file = osp.join(self.cache_dir, "{}_{}.npy".format(name, field))
+        if not osp.exists(field_file):
+            occupancy_grid = np.load(osp.join(self.cache_dir, name + ".npy"))
+            self._save_array(field_file, build_fn(occupancy_grid))
+        return np.load(field_file, mmap_mode="r" if self.mmap else None)
+
+
+class MapLRUCache(object):
+    '''
+    Bounded in-process cache of decoded occupancy grids, evicting the least recently used map first.
+
+    Cached grids are shared by every `Map` built from this store. `Map` only copies the crop window out of
+    them, so cached arrays are never modified. Safe to use from several threads (e.g. a map prefetcher), a map
+    missed by two threads at once is just loaded twice.
+    '''
+    ## keys of stats(), maps and derived grids (get_field) are counted separately
+    stat_keys = ("hits", "misses", "evictions", "field_hits", "field_misses", "field_evictions", "entries", "nbytes")
+
+    def __init__(self, source=None, max_entries=None, max_bytes=None, packed=False):
+        '''
+        :param source: store used on a cache miss (e.g. a MapDiskCache). If None, floorplans are decoded.
+        :param max_entries: maximum number of cached maps. None means unbounded.
+        :param max_bytes: maximum total size of the cached grids (in bytes). None means unbounded.
+        :param packed: if True, occupancy grids are cached as PackedGrid, so max_bytes holds 8x more maps.
+        '''
+        self.source = source
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.packed = packed
+
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.field_hits = 0
+        self.field_misses = 0
+        self.field_evictions = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _lookup(self, key):
+        ## keys of derived grids have a third item, the name of the grid
+        field = len(key) > 2
+        with self.lock:
+            if key in self.entries:
+                if field:
+                    self.field_hits += 1
+                else:
+                    self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            if field:
+                self.field_misses += 1
+            else:
+                self.misses += 1
+            return None
+
+    def get(self, config_file, downsample_factor=1):
+        key = (osp.abspath(config_file), downsample_factor)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        if self.source is None:
+            entry = load_floorplan(config_file, downsample_factor)
+        else:
+            entry = self.source.get(config_file, downsample_factor)
+        if self.packed and not isinstance(entry[0], PackedGrid):
+            entry = (PackedGrid.pack(entry[0]),) + tuple(entry[1:])
+        self._add(key, entry)
+        return entry
+
+    def get_field(self, config_file, downsample_factor, field, build_fn):
+        '''
+        Get a grid derived from the full occupancy grid (see MapDiskCache.get_field). Derived grids are cached
+        like maps and count towards the same limits.
+        '''
+        key = (osp.abspath(config_file), downsample_factor, field)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry[0]
+
+        if self.source is not None and hasattr(self.source, "get_field"):
+            grid = self.source.get_field(config_file, downsample_factor, field, build_fn)
+        else:
+            grid = build_fn(self.get(config_file, downsample_factor)[0])
+        self._add(key, (grid,))
+        return grid
+
+    def _add(self, key, entry):
+        with self.lock:
+            if key in self.entries:
+                ## loaded by another thread meanwhile
+                self.nbytes -= self.entries[key][0].nbytes
+            self.entries[key] = entry
+            self.nbytes += entry[0].nbytes
+            self._evict()
+
+    def _evict(self):
+        # the most recent entry is always kept, even if it alone exceeds max_bytes
+        while len(self.entries) > 1 and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            key, entry = self.entries.popitem(last=False)
+            self.nbytes -= entry[0].nbytes
+            if len(key) > 2:
+                self.field_evictions += 1
+            else:
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+        :return: a dict with the hit/miss/eviction counters of the maps and of the derived grids (`field_*`), and the
+                 current number of entries and size of the cache, see `stat_keys`.
+        '''
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "field_hits": self.field_hits, "field_misses": self.field_misses,
+                "field_evictions": self.field_evictions, "entries": len(self.entries), "nbytes": self.nbytes}
+
+
+class SharedMapStore(object):
+    '''
+    Read-only store of occupancy grids shared by all DataLoader workers.
+
+    The parent process decodes every map once and packs the grids into a single file (in /dev/shm when
+    available). Workers memory-map that file, so `get` returns zero-copy views backed by the same physical
+    pages in every process instead of one private copy per worker.
+    '''
+
+    def __init__(self, config_files, downsample_factor=1, source=None, shm_dir=None, packed=False):
+        '''
+        :param config_files: floorplan .yaml files to put in the store.
+        :param downsample_factor: downsample factor of the stored grids.
+        :param source: store used to load the grids (e.g. a MapDiskCache). If None, floorplans are decoded.
+        :param shm_dir: directory of the backing file. Defaults to /dev/shm, or the temp dir if missing.
+        :param packed: if True, the grids are stored bit-packed (8x smaller) and returned as PackedGrid.
+        '''
+        self.downsample_factor = downsample_factor
+        self.source = source
+        self.packed = packed
+
+        entries = []
+        for config_file in config_files:
+            if source is None:
+                occupancy_grid, origin, resolution = load_floorplan(config_file, downsample_factor)
+            else:
+                occupancy_grid, origin, resolution = source.get(config_file, downsample_factor)
+            ## stored rows: the grid itself, or its packed bits
+            stored = PackedGrid.pack(occupancy_grid).bits if packed else np.asarray(occupancy_grid, dtype=np.uint8)
+            entries.append((stored, occupancy_grid.shape, origin, resolution))
+
+        self.index = {}
+        offset = 0
+        for config_file, (stored, shape, origin, resolution) in zip(config_files, entries):
+            key = osp.abspath(config_file)
+            self.index[key] = (offset, stored.shape, tuple(shape), np.array(origin), resolution)
+            offset += stored.size
+        self.nbytes = offset
+
+        if shm_dir is None:
+            shm_dir = "/dev/shm" if osp.isdir("/dev/shm") else tempfile.gettempdir()
+        fd, self.path = tempfile.mkstemp(prefix="map_store_", suffix=".bin", dir=shm_dir)
+        os.close(fd)
+        self.owner_pid = os.getpid()
+        atexit.register(self.close)
+
+        buffer = np.memmap(self.path, dtype=np.uint8, mode="w+", shape=(max(self.nbytes, 1),))
+        for config_file, (stored, _, _, _) in zip(config_files, entries):
+            offset = self.index[osp.abspath(config_file)][0]
+            buffer[offset:offset + stored.size] = stored.ravel()
+        buffer.flush()
+        del buffer
+        self._buffer = None
+        ## derived grids are computed lazily by every process, see get_field()
+        self.fields = {}
+
+    def __getstate__(self):
+        # workers started with spawn re-open the backing file instead of pickling the mapping
+        state = self.__dict__.copy()
+        state["_buffer"] = None
+        state["fields"] = {}
+        return state
+
+    def _get_buffer(self):
+        if self._buffer is None:
+            self._buffer = np.memmap(self.path, dtype=np.uint8, mode="r", shape=(max(self.nbytes, 1),))
+        return self._buffer
+
+    def get(self, config_file, downsample_factor=1):
+        key = osp.abspath(config_file)
+        if key not in self.index or downsample_factor != self.downsample_factor:
+            if self.source is None:
+                return load_floorplan(config_file, downsample_factor)
+            return self.source.get(config_file, downsample_factor)
+
+        offset, stored_shape, shape, origin, resolution = self.index[key]
+        size = int(np.prod(stored_shape))
+        occupancy_grid = self._get_buffer()[offset:offset + size].reshape(stored_shape)
+        if self.packed:
+            occupancy_grid = PackedGrid(occupancy_grid, shape)
+        return occupancy_grid, origin, resolution
+
+    def get_field(self, config_file, downsample_factor, field, build_fn):
+        '''
+        Get a grid derived from the full occupancy grid (see MapDiskCache.get_field). Uses the source store if it
+        caches derived grids, otherwise computes it once per process.
+        '''
+        if self.source is not None and hasattr(self.source, "get_field"):
+            return self.source.get_field(config_file, downsample_factor, field, build_fn)
+        key = (osp.abspath(config_file), downsample_factor, field)
+        if key not in self.fields:
+            self.fields[key] = build_fn(self.get(config_file, downsample_factor)[0])
+        return self.fields[key]
+
+    def close(self):
+        '''
+        Remove the backing file. Only the process that created the store does so.
+        '''
+        self._buffer = None
+        if os.getpid() == self.owner_pid and osp.exists(self.path):
+            os.remove(self.path)
+
+
+def build_map_store(cfg):
+    '''
+    Create the map store described by the `data` section of a config.
+    :return: a store object for `Map`, or None to decode floorplans directly.
+    '''
+    store = None
+    cache_dir = cfg.data.get("map_cache_dir", None)
+    if cache_dir:
+        store = MapDiskCache(cache_dir, tile_size=cfg.data.get("map_cache_tile", None))
+
+    if cfg.data.get("shared_map_store", False):
+        config_files = sorted(glob.glob(osp.join(cfg.data.occu_map_dir, "*", "floorplan.yaml")))
+        store = SharedMapStore(config_files, cfg.data.downsample_factor, source=store,
+                               packed=cfg.data.get("map_store_packed", False))
+
+    max_entries = cfg.data.get("map_lru_entries", None)
+    max_bytes = cfg.data.get("map_lru_bytes", None)
+    if max_entries or max_bytes:
+        store = MapLRUCache(store, max_entries=max_entries, max_bytes=max_bytes,
+                            packed=cfg.data.get("map_store_packed", False))
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the on-disk occupancy map cache.")
+    parser.add_argument("--map_dir", type=str, nargs="+", default=["data/maps_train", "data/maps_test"])
+    parser.add_argument("--cache_dir", type=str, default="data/map_cache")
+    parser.add_argument("--downsample_factor", type=int, nargs="+", default=[4])
+    parser.add_argument("--force", action="store_true", help="rebuild entries that are up to date")
+    parser.add_argument("--distance_field", action="store_true", help="also build the distance fields (sdf)")
+    parser.add_argument("--lut_bins", type=int, default=0,
+                        help="also build directional distance tables (lut) with this many heading bins")
+    parser.add_argument("--laser_max_range", type=float, default=4, help="range of the directional distance tables")
+    parser.add_argument("--tile_size", type=int, default=0, help="also store the grids as tiles of this size")
+    args = parser.parse_args()
+
+    cache = MapDiskCache(args.cache_dir, tile_size=args.tile_size or None)
+    config_files = []
+    for map_dir in args.map_dir:
+        config_files += sorted(glob.glob(osp.join(map_dir, "*", "floorplan.yaml")))
+
+    s = time.time()
+    for config_file in config_files:
+        for downsample_factor in args.downsample_factor:
+            name = cache.build(config_file, downsample_factor, force=args.force)
+            print("{} (x{}) -> {}".format(config_file, downsample_factor, name))
+            if args.tile_size > 0:
+                cache.get_tiles(name)
+            if args.distance_field:
+                cache.get_field(config_file, downsample_factor, "distance_field", compute_distance_field)
+            if args.lut_bins > 0:
+                # same table as Map.get_distance_table()
+                _, _, resolution = cache.get(config_file, downsample_factor)
+                max_cells = int(np.ceil(args.laser_max_range * int(1.0 / resolution)))
+                t = time.time()
+                cache.get_field(config_file, downsample_factor, "free_index", compute_free_index)
+                table = cache.get_field(config_file, downsample_factor,
+                                        "directional_distances_{}_{}".format(args.lut_bins, max_cells),
+                                        functools.partial(compute_directional_distances,
+                                                          n_bins=args.lut_bins, max_cells=max_cells))
+                print("    directional distance table: {}, {:.1f}MB, {:.1f}s".format(
+                    table.shape, table.nbytes / 2**20, time.time() - t))
+    print("cached {} maps in {:.1f}s".format(len(config_files), time.time() - s))
+
+
+if __name__ == "__main__":
+    main()
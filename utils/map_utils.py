@@ -1,4 +1,5 @@
 import os
+import functools
 import cv2
 import numpy as np
 import yaml
@@ -24,6 +25,24 @@ def depth_to_xy(depth, pos, heading, fov):
     return pos + xy
 
 
+def depth_to_xy_batch(depth, poses, headings, fov):
+    '''
+    Batch version of depth_to_xy(), identical to calling it on every scan.
+    :param depth: a numpy array of size N x M containing N scans of M depth rays
+    :param poses: positions of the sensor. A numpy array of size N x 2, or None for sensor-centered points.
+    :param headings: orientations of the sensor (in radians). A numpy array of size N.
+    :param fov: field of view of the sensor.
+    :return: a numpy array of size N x M x 2, the global x, y coordinates of depth points.
+    '''
+    n_bins = depth.shape[1]
+    theta = np.linspace(-fov * 0.5, fov * 0.5, n_bins, endpoint=False)
+    angles = theta[None, :] + np.asarray(headings).reshape(-1, 1)
+    xy = np.stack([np.cos(angles) * depth, np.sin(angles) * depth], axis=2)
+    if poses is None:
+        return xy
+    return np.asarray(poses).reshape(-1, 1, 2) + xy
+
+
 def rotate_2d(v, angle):
     '''
     Rotate one or more points.
@@ -46,62 +65,266 @@ def rotate_2d(v, angle):
         raise ValueError
 
 
+def load_floorplan(config_file, downsample_factor=1):
+    '''
+    Decode a floorplan into a downsampled occupancy grid.
+    :param config_file: a .yaml file containing meta data of the map.
+    :param downsample_factor: an integer for downsampling the occupancy map.
+    :return: a tuple (occupancy_grid, origin, resolution). occupancy_grid is a uint8 numpy array where
+             0 means no obstacle and 255 means obstacle.
+    '''
+    path = os.path.abspath(config_file)
+    cfg = yaml.load(open(config_file).read(), Loader=yaml.SafeLoader)
+
+    img_file = os.path.join(os.path.dirname(path), cfg['image'])
+
+    bitmap = cv2.imread(img_file, cv2.IMREAD_GRAYSCALE)
+    free_space = (bitmap >= 250).astype(np.uint8)
+
+    if downsample_factor > 1:
+        free_space = cv2.resize(free_space, None, fx=1.0/downsample_factor, fy=1.0/downsample_factor)
+
+    # 0 means no obstacle
+    occupancy_grid = (1 - free_space) * 255
+
+    # Pixel coordinate representing the origin of the occupancy grid.
+    ## origin is always zero for all maps
+    origin = np.array(cfg['origin']) / downsample_factor
+
+    resolution = float(cfg['resolution']) * downsample_factor
+    return occupancy_grid, origin, resolution
+
+
+## mask of the bit of every column of a byte of a bit-packed grid, see pack_occupancy()
+_bit_masks = np.array([128, 64, 32, 16, 8, 4, 2, 1], dtype=np.uint8)
+
+
+def pack_occupancy(occupancy_grid):
+    '''
+    Bit-pack an occupancy grid: one bit per cell, set for obstacles, so 8x smaller than the uint8 grid of
+    load_floorplan().
+    :param occupancy_grid: a numpy array where 0 means no obstacle.
+    :return: the (height, ceil(width / 8)) uint8 numpy array of np.packbits(occupancy_grid != 0, axis=1).
+    '''
+    return np.packbits(np.asarray(occupancy_grid) != 0, axis=1)
+
+
+def unpack_occupancy(bits, width):
+    '''
+    Inverse of pack_occupancy().
+    :param bits: the bit-packed grid.
+    :param width: width of the grid.
+    :return: a uint8 numpy array where 0 means no obstacle and 255 means obstacle.
+    '''
+    return np.unpackbits(bits, axis=1, count=width) * np.uint8(255)
+
+
+def compute_distance_field(occupancy_grid):
+    '''
+    Euclidean distance transform of the free space of an occupancy grid.
+    :param occupancy_grid: a numpy array where 0 means no obstacle.
+    :return: a float32 numpy array of the same size containing, for every cell, the distance (in cells) from its
+             center to the center of the nearest occupied cell. Occupied cells are 0.
+    '''
+    free_space = (np.asarray(occupancy_grid) == 0).astype(np.uint8)
+    return cv2.distanceTransform(free_space, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+
+def compute_free_index(occupancy_grid):
+    '''
+    :param occupancy_grid: a numpy array where 0 means no obstacle.
+    :return: an int32 numpy array of the same size containing the index of every free cell in row-major order
+             (the column of the cell in compute_directional_distances()), and -1 for occupied cells.
+    '''
+    free_space = np.asarray(occupancy_grid) == 0
+    index = np.full(free_space.shape, -1, dtype=np.int32)
+    index[free_space] = np.arange(np.count_nonzero(free_space), dtype=np.int32)
+    return index
+
+
+def compute_free_integral(occupancy_grid):
+    '''
+    :param occupancy_grid: a numpy array where 0 means no obstacle.
+    :return: the summed-area table of the free cells, an int32 numpy array with one more row and column than the
+             grid: entry (i, j) is the number of free cells in occupancy_grid[:i, :j].
+    '''
+    return cv2.integral((np.asarray(occupancy_grid) == 0).astype(np.uint8), sdepth=cv2.CV_32S)
+
+
+def compute_crop_offsets(occupancy_grid, crop_size, min_free_fraction=0.0):
+    '''
+    Catalog of the valid crops of a map: the free cells of every crop_size x crop_size window are counted in
+    constant time from the summed-area table of the grid.
+    :param occupancy_grid: a numpy array where 0 means no obstacle.
+    :param crop_size: size of the square crops.
+    :param min_free_fraction: a crop is valid if at least this fraction of its cells (and at least one) is free.
+    :return: an int32 numpy array of the flat indices row * (width - crop_size + 1) + column of the top-left corners
+             of the valid crops. If no crop is valid, those of the crops with the most free cells.
+    '''
+    integral = compute_free_integral(occupancy_grid)
+    t = crop_size
+    counts = integral[t:, t:] - integral[:-t, t:] - integral[t:, :-t] + integral[:-t, :-t]
+    min_free = max(1, int(np.ceil(min_free_fraction * t * t)))
+    offsets = np.flatnonzero(counts >= min_free)
+    if len(offsets) == 0:
+        offsets = np.flatnonzero(counts == counts.max())
+    return offsets.astype(np.int32)
+
+
+def compute_directional_distances(occupancy_grid, n_bins, max_cells):
+    '''
+    Directional distance table of the free space: for `n_bins` headings evenly spaced over 360 degrees, the
+    distance from every free cell to the nearest obstacle in that direction. For each heading, the grid is rotated
+    so that the heading points along the rows, the distances are found with one scan per row, and the result is
+    read back at the free cells. Cells outside the grid repeat the border cells, like the clamping of
+    Map.get_1d_depth().
+    :param occupancy_grid: a numpy array where 0 means no obstacle.
+    :param n_bins: number of heading bins.
+    :param max_cells: distances are capped at this value (in cells).
+    :return: a numpy array of size n_bins x n_free containing distances in cells between cell centers, in the
+             free cell order of compute_free_index(). uint8 if max_cells < 255, uint16 otherwise.
+    '''
+    occupied = (np.asarray(occupancy_grid) != 0).astype(np.uint8)
+    h, w = occupied.shape
+    free_rows, free_cols = np.nonzero(occupied == 0)
+
+    # square canvas large enough to hold the rotated grid
+    size = int(np.ceil(np.hypot(h, w))) + 2
+    center_x, center_y = (w - 1) * 0.5, (h - 1) * 0.5
+    canvas_center = (size - 1) * 0.5
+    cols = np.arange(size).reshape(1, -1)
+    no_obstacle = size + max_cells
+
+    table = np.empty((n_bins, len(free_rows)), dtype=np.uint8 if max_cells < 255 else np.uint16)
+    for b in range(n_bins):
+        c, s = np.cos(2 * np.pi * b / n_bins), np.sin(2 * np.pi * b / n_bins)
+        # maps canvas (u, v) to grid (x, y), so that +u on the canvas is the heading direction on the grid
+        m = np.array([[c, -s, center_x - c * canvas_center + s * canvas_center],
+                      [s, c, center_y - s * canvas_center - c * canvas_center]])
+        rotated = cv2.warpAffine(occupied, m, (size, size), flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                                 borderMode=cv2.BORDER_REPLICATE)
+
+        # distance to the next occupied pixel along every row
+        next_occupied = np.where(rotated != 0, cols, no_obstacle)
+        next_occupied = np.minimum.accumulate(next_occupied[:, ::-1], axis=1)[:, ::-1]
+        distances = np.minimum(next_occupied - cols, max_cells)
+
+        # canvas position of every free cell
+        us = np.rint(c * (free_cols - center_x) + s * (free_rows - center_y) + canvas_center).astype(np.int64)
+        vs = np.rint(-s * (free_cols - center_x) + c * (free_rows - center_y) + canvas_center).astype(np.int64)
+        table[b] = distances[vs, us]
+    return table
+
+
 class Map(object):
-    def __init__(self, config_file, laser_max_range=10.0, downsample_factor=1, crop_size=None):
+    ## raycasting backends of get_1d_depth(), implemented by the `_<name>_rays` methods
+    raycast_methods = ("march", "dda", "sdf", "lut")
+
+    def __init__(self, config_file, laser_max_range=10.0, downsample_factor=1, crop_size=None, store=None,
+                 raycast_method="march", sdf_tolerance=None, lut_bins=180, min_free_fraction=0.0):
         '''
         :config_file: a .yaml file containing meta data of the map.
         :laser_max_range: maximum range of the laser scanner (in meters).
         :downsample_factor: an integer for downsampling the occupancy map.
                             E.g., 2 means that the width and height will be divided by 2.
+        :store: an optional map store (see utils.map_cache) providing a `get(config_file, downsample_factor)`
+                method. If None the floorplan is decoded from disk.
+        :raycast_method: default raycasting backend of get_1d_depth(), one of `Map.raycast_methods`.
+                         "march" samples every ray at a fixed step, "dda" traverses the grid cells exactly,
+                         "sdf" sphere-traces the rays on the distance field of the map and "lut" reads the depths
+                         from a precomputed directional distance table. "lut" needs a `store` with a `get_field`
+                         method: the table is built once per map and cached by the store, building it for every
+                         Map would be slower than marching.
+        :sdf_tolerance: smallest sphere tracing step (in meters) of the "sdf" backend: closer to obstacles, rays
+                        are finished with the exact traversal of "dda", so this only affects the speed.
+                        If None the depth resolution passed to get_1d_depth() is used.
+        :lut_bins: number of heading bins of the "lut" backend's distance table.
+        :min_free_fraction: random crops are drawn among those with at least this fraction of free cells (and at
+                            least one free cell), see compute_crop_offsets().
         '''
-        path = os.path.abspath(config_file)
-        self.cfg = yaml.load(open(config_file).read(), Loader=yaml.SafeLoader)
-
-        img_file = os.path.join(os.path.dirname(path), self.cfg['image'])
-
-        bitmap = cv2.imread(img_file, cv2.IMREAD_GRAYSCALE)
-        free_space = (bitmap >= 250).astype(np.uint8)
-
-        if downsample_factor > 1:
-            free_space = cv2.resize(free_space, None, fx=1.0/downsample_factor, fy=1.0/downsample_factor)
-
-        # 0 means no obstacle
-        self.occupancy_grid = (1 - free_space) * 255
+        if raycast_method not in self.raycast_methods:
+            raise ValueError("Unknown raycast method {}".format(raycast_method))
+        if raycast_method == "lut" and not hasattr(store, 'get_field'):
+            raise ValueError("The lut raycast method needs a map store caching derived grids, see utils.map_cache")
+        self.raycast_method = raycast_method
+        self.sdf_tolerance = sdf_tolerance
+        self.lut_bins = lut_bins
+
+        self.config_file = config_file
+        self.downsample_factor = downsample_factor
+        self.store = store
+        ## (row, column, height, width) of the crop in the full map, None if not cropped
+        self.crop_window = None
+        ## grids derived from the occupancy grid (e.g. the distance field), see get_derived_grid()
+        self.derived_grids = {}
+
+        if store is None:
+            grid, self.origin, self.resolution = load_floorplan(config_file, downsample_factor)
+        else:
+            grid, self.origin, self.resolution = store.get(config_file, downsample_factor)
 
-        # 255 means no obstacle. For visualization purpose.
-        self.inv_occupancy_grid = (255 - self.occupancy_grid)
-
-        # Pixel coordinate representing the origin of the occupancy grid.
-        ## origin is always zero for all maps
-        self.origin = np.array(self.cfg['origin']) / downsample_factor
-
-        self.resolution = float(self.cfg['resolution']) * downsample_factor
         self.n_division = int(1.0 / self.resolution)  # Number of pixels / m
         # 1.0 / self.resolution should be an integer.
         assert self.n_division - 1.0 / self.resolution < 1, 'Bad downsampling factor'
 
         ## random crop (after crop, we still set origin as zero)
         if crop_size is not None:
-            self._random_crop(crop_size)
+            grid = self._random_crop(grid, crop_size, min_free_fraction)
 
-        self.map_bbox = self._compute_map_bbox()
-        self.area = self._compute_free_area()
+        # The map keeps its grid bit-packed, see pack_occupancy(). Raycasting and sampling read the bits directly,
+        # the uint8 occupancy_grid is only expanded on first use (e.g. as model input). Stored grids may be memory
+        # maps, tiled or bit-packed grids (see utils.map_cache): only the (cropped) window is read.
+        self.shape = tuple(grid.shape)
+        self.occupancy_bits = pack_occupancy(grid)
+
+        ## occupancy_grid, inv_occupancy_grid, map_bbox and area are computed on first use, most maps never need them
+
+        ## flat indices of free cells, built on first use by sample_free_positions()
+        self.free_cells = None
 
         self.laser_max_range = laser_max_range
 
     ### add by xiaojuan for random crop
-    def _random_crop(self, crop_size):
-        h, w = self.occupancy_grid.shape
+    def _random_crop(self, grid, crop_size, min_free_fraction=0.0):
+        h, w = grid.shape
         th = tw = crop_size
-        while True:
-            h1 = random.randint(0, h - th)
-            w1 = random.randint(0, w - tw)
-            crops = self.occupancy_grid[h1:(h1+th), w1:(w1+tw)]
-            if (np.sum((crops == 0)) > 0):
-                break
+        ## uniform over the valid crops, whatever the sparsity of the map. Cached by the map store, if any
+        offsets = self.get_derived_grid('crop_offsets_{}_{}'.format(crop_size, min_free_fraction),
+                                        functools.partial(compute_crop_offsets, crop_size=crop_size,
+                                                          min_free_fraction=min_free_fraction),
+                                        crop=False, source=grid)
+        h1, w1 = divmod(int(offsets[random.randrange(len(offsets))]), w - tw + 1)
+
+        self.crop_window = (h1, w1, th, tw)
+        return grid[h1:(h1+th), w1:(w1+tw)]
+
+    @functools.cached_property
+    def occupancy_grid(self):
+        # uint8, 0 means no obstacle and 255 means obstacle
+        return unpack_occupancy(self.occupancy_bits, self.shape[1])
+
+    def occupied(self, rows, cols):
+        '''
+        :param rows: an integer numpy array of rows of the occupancy grid.
+        :param cols: an integer numpy array of columns of the occupancy grid, of the same size.
+        :return: a boolean numpy array, True for the occupied cells. Read from the bit-packed grid.
+        '''
+        cells = rows * self.occupancy_bits.shape[1] + (cols >> 3)
+        ## np.take on the flat grid is much faster than 2D fancy indexing
+        return (self.occupancy_bits.ravel().take(cells) & _bit_masks.take(cols & 7)) != 0
+
+    @functools.cached_property
+    def inv_occupancy_grid(self):
+        # 255 means no obstacle. For visualization purpose.
+        return 255 - self.occupancy_grid
 
-        self.occupancy_grid = self.occupancy_grid[h1:(h1+th), w1:(w1+tw)]
-        self.inv_occupancy_grid = self.inv_occupancy_grid[h1:(h1+th), w1:(w1+tw)]
+    @functools.cached_property
+    def map_bbox(self):
+        return self._compute_map_bbox()
+
+    @functools.cached_property
+    def area(self):
+        return self._compute_free_area()
 
     def _compute_free_area(self):
         return np.sum((self.occupancy_grid == 0)) * self.resolution**2
@@ -120,6 +343,79 @@ class Map(object):
 
         return x_min, x_max, y_min, y_max
 
+    def get_derived_grid(self, name, build_fn, crop=True, source=None):
+        '''
+        Get a grid computed from the occupancy grid, cropped like the occupancy grid. If the map store supports it
+        (see utils.map_cache), the grid is computed once on the full map and cached by the store. Otherwise it is
+        computed on this map's occupancy grid.
+        :param name: name of the grid, used as cache key.
+        :param build_fn: a module-level function (or functools.partial of one) mapping a full occupancy grid to
+                         the derived grid.
+        :param crop: if False, the grid of the store is returned as is instead of being cropped.
+        :param source: occupancy grid to compute the grid on when there is no store, this map's by default.
+        '''
+        if name not in self.derived_grids:
+            if self.store is not None and hasattr(self.store, 'get_field'):
+                grid = self.store.get_field(self.config_file, self.downsample_factor, name, build_fn)
+                if crop and self.crop_window is not None:
+                    h1, w1, th, tw = self.crop_window
+                    grid = grid[h1:(h1+th), w1:(w1+tw)]
+            else:
+                grid = build_fn(self.occupancy_grid if source is None else source)
+            self.derived_grids[name] = grid
+        return self.derived_grids[name]
+
+    def get_distance_field(self):
+        '''
+        :return: the Euclidean distance (in cells) from every cell to the nearest obstacle, see
+                 compute_distance_field(). For a cropped map cached by a store, the distances are computed on the
+                 full map, so obstacles just outside the crop are taken into account.
+        '''
+        return self.get_derived_grid('distance_field', compute_distance_field)
+
+    def get_distance_table(self):
+        '''
+        Directional distance table of the "lut" raycasting backend, see compute_directional_distances(). The table
+        is cached by the map store: without a store that caches derived grids it would be rebuilt for every Map.
+        :return: a tuple (free_index, table, offset). `free_index` maps cells to columns of `table`, and
+                 `offset` is the (row, column) of this map's occupancy grid in `free_index`: if the table is
+                 cached by the map store it covers the full map, not just the crop.
+        '''
+        if not hasattr(self.store, 'get_field'):
+            raise ValueError("The lut raycast method needs a map store caching derived grids, see utils.map_cache")
+        max_cells = int(np.ceil(self.laser_max_range * self.n_division))
+        free_index = self.get_derived_grid('free_index', compute_free_index, crop=False)
+        table = self.get_derived_grid('directional_distances_{}_{}'.format(self.lut_bins, max_cells),
+                                      functools.partial(compute_directional_distances,
+                                                        n_bins=self.lut_bins, max_cells=max_cells),
+                                      crop=False)
+        if free_index.shape != self.shape:
+            offset = self.crop_window[:2]
+        else:
+            offset = (0, 0)
+        return free_index, table, offset
+
+    def sample_free_positions(self, n=None):
+        '''
+        Uniformly sample world positions in free space. A free cell is drawn from the flat index of free
+        cells and the position is jittered uniformly inside that cell, so the cost does not depend on how
+        much of the map is occupied.
+        :param n: number of positions. If None a single position is sampled.
+        :return: a numpy array of size 2 (if n is None) or N x 2 containing world (x, y) positions.
+        '''
+        if self.free_cells is None:
+            self.free_cells = np.flatnonzero(np.unpackbits(self.occupancy_bits, axis=1, count=self.shape[1]) == 0)
+
+        size = 1 if n is None else n
+        cells = self.free_cells[np.random.randint(0, len(self.free_cells), size)]
+        grid_y, grid_x = np.divmod(cells, self.shape[1])
+        xs = (grid_x + np.random.uniform(0, 1, size)) / self.n_division + self.origin[0]
+        ys = (grid_y + np.random.uniform(0, 1, size)) / self.n_division + self.origin[1]
+        xys = np.stack([xs, ys], axis=1)
+        if n is None:
+            return xys[0]
+        return xys
+
     def grid_coord(self, x, y):
         '''
         :return: the grid coordinates where (x, y) falls
@@ -139,7 +435,14 @@ class Map(object):
         '''
         return float(x) / self.n_division + self.origin[0], float(y) / self.n_division + self.origin[1]
 
-    def get_1d_depth(self, pos, heading, fov, n_depth_ray, resolution=None):
+    def world_coord_batch(self, xys):
+        """
+        Batch version of world_coord()
+        :param xys: N x 2 np array of grid coordinates
+        """
+        return np.asarray(xys, dtype=float) / self.n_division + np.array(self.origin[:2], dtype=float)
+
+    def get_1d_depth(self, pos, heading, fov, n_depth_ray, resolution=None, method=None):
         '''
         :param pos: a numpy array of size 2 representing the global location of the robot (in meters).
         :param heading: heading of the robot (in radians). A float.
@@ -147,36 +450,335 @@ class Map(object):
         :param n_depth_ray: number of depth rays. An integer.
         :param resolution: Resolution when estimating depths. Higher value will decrease the depth accuracy but
                            increase speed. If None will use the map resolution.
+        :param method: raycasting backend, one of `Map.raycast_methods`. If None will use `self.raycast_method`.
         :return: a numpy array of size `n_depth_ray` representing measured depths (in meters).
         '''
-        thetas = np.linspace(-fov * 0.5, fov * 0.5, n_depth_ray, endpoint=False)
-        ray_dir_x = np.cos(thetas + heading)
-        ray_dir_y = np.sin(thetas + heading)
-        ray_dirs = np.stack([ray_dir_x, ray_dir_y], axis=-1)
+        return self.get_1d_depth_batch(np.asarray(pos).reshape(1, 2), np.array([heading]), fov, n_depth_ray,
+                                       resolution=resolution, method=method)[0]
+
+    def get_1d_depth_batch(self, poses, headings, fov, n_depth_ray, resolution=None, method=None,
+                           max_elements=2**16):
+        '''
+        Batch version of get_1d_depth(). Casts the scans of N poses in one vectorized pass; the result for every
+        pose is identical to calling get_1d_depth() on it.
+        :param poses: a numpy array of size N x 2 containing the global locations of the robot (in meters).
+        :param headings: a numpy array of size N containing the headings of the robot (in radians).
+        :param max_elements: upper bound on the number of ray samples processed at once. Poses are split into
+                             chunks so that the intermediate arrays stay below this size.
+        :return: a numpy array of size N x `n_depth_ray` representing measured depths (in meters).
+        '''
+        poses = np.asarray(poses).reshape(-1, 2)
+        headings = np.asarray(headings).reshape(-1)
 
         if resolution is None:
             resolution = self.resolution
+        if method is None:
+            method = self.raycast_method
+        if method not in self.raycast_methods:
+            raise ValueError("Unknown raycast method {}".format(method))
+        cast_rays = getattr(self, "_{}_rays".format(method))
 
+        n_poses = poses.shape[0]
         n_steps = int(self.laser_max_range / resolution)
+        if method == "march":
+            chunk = max(1, max_elements // max(1, n_steps * n_depth_ray))
+        else:
+            chunk = max(1, max_elements // n_depth_ray)
+
+        depth = np.empty((n_poses, n_depth_ray))
+        for i in range(0, n_poses, chunk):
+            depth[i:i + chunk] = cast_rays(poses[i:i + chunk], headings[i:i + chunk], fov, n_depth_ray,
+                                           resolution, n_steps)
+        return depth
 
-        # (n_steps, n_ray, 2)
-        ray_endpoints = pos.reshape((1, 1, 2)) + \
-                        ray_dirs.reshape(1, n_depth_ray, 2) * resolution * \
-                        np.arange(n_steps).reshape(n_steps, 1, 1)
+    @staticmethod
+    def stack_grids(maps, fill_value=0):
+        '''
+        :param maps: a list of N maps.
+        :return: the occupancy grids of the maps, padded with `fill_value` to the largest of them and stacked into
+                 an N x H x W numpy array, and their N x 2 (height, width) sizes.
+        '''
+        shapes = np.array([m.shape for m in maps])
+        grids = np.full((len(maps),) + tuple(shapes.max(0)), fill_value, dtype=np.uint8)
+        for i, m in enumerate(maps):
+            grids[i, :shapes[i, 0], :shapes[i, 1]] = m.occupancy_grid
+        return grids, shapes
+
+    @staticmethod
+    def get_1d_depth_multi(maps, poses, headings, fov, n_depth_ray, resolution=None, method=None,
+                           max_elements=2**16, grids=None):
+        '''
+        Scans of N poses in N different maps, identical to maps[i].get_1d_depth(poses[i], headings[i], ...).
+        With the "march" backend and maps of the same resolution and range, all the rays are marched in one
+        vectorized pass over the stacked (padded) occupancy grids; otherwise every map casts its own scan.
+        :param maps: a list of N maps.
+        :param poses: a numpy array of size N x 2, the global location of the robot in every map (in meters).
+        :param headings: a numpy array of size N containing the headings of the robot (in radians).
+        :param grids: the stacked grids of the maps from Map.stack_grids(), if already available.
+        :return: a numpy array of size N x `n_depth_ray` representing measured depths (in meters).
+        '''
+        poses = np.asarray(poses).reshape(-1, 2)
+        headings = np.asarray(headings).reshape(-1)
+        n_poses = len(maps)
+        methods = set([method or m.raycast_method for m in maps])
+        resolutions = set([resolution or m.resolution for m in maps])
+        ranges = set([m.laser_max_range for m in maps])
+        if methods != {"march"} or len(resolutions) > 1 or len(ranges) > 1:
+            return np.stack([m.get_1d_depth(pose, heading, fov, n_depth_ray, resolution=resolution, method=method)
+                             for m, pose, heading in zip(maps, poses, headings)])
+
+        resolution = resolutions.pop()
+        n_steps = int(ranges.pop() / resolution)
+        if grids is None:
+            grids, shapes = Map.stack_grids(maps)
+        else:
+            shapes = np.array([m.shape for m in maps])
+        origins = np.array([m.origin[:2] for m in maps], dtype=float)
+        n_divisions = np.array([m.n_division for m in maps])
+
+        chunk = max(1, max_elements // max(1, n_steps * n_depth_ray))
+        depth = np.empty((n_poses, n_depth_ray))
+        for i in range(0, n_poses, chunk):
+            idx = np.arange(i, min(i + chunk, n_poses))
+            ray_dirs = maps[0]._ray_dirs(headings[idx], fov, n_depth_ray)
+            # (n, n_steps, n_ray, 2), as in _march_rays() but in the grid of every pose's own map
+            ray_endpoints = poses[idx].reshape((-1, 1, 1, 2)) + \
+                            ray_dirs.reshape(-1, 1, n_depth_ray, 2) * resolution * \
+                            np.arange(n_steps).reshape(1, n_steps, 1, 1)
+            ray_grid_coords = ((ray_endpoints - origins[idx].reshape(-1, 1, 1, 2)) *
+                               n_divisions[idx].reshape(-1, 1, 1, 1)).astype(np.int32)
+            # clamp to the map's own borders, so the padding is never read
+            np.clip(ray_grid_coords[..., 0], 0, (shapes[idx, 1] - 1).reshape(-1, 1, 1), out=ray_grid_coords[..., 0])
+            np.clip(ray_grid_coords[..., 1], 0, (shapes[idx, 0] - 1).reshape(-1, 1, 1), out=ray_grid_coords[..., 1])
+
+            ## one flat gather from the stacked grids
+            flat = (idx.reshape(-1, 1, 1) * grids.shape[1] + ray_grid_coords[..., 1]) * grids.shape[2] + \
+                ray_grid_coords[..., 0]
+            values = grids.reshape(-1)[flat]
+            hits = values != 0
+            hits[:, -1, :] = 1
+            depth[idx] = np.argmax(hits, axis=1) * resolution
+        return depth
+
+    def _ray_dirs(self, headings, fov, n_depth_ray):
+        # (N, n_ray, 2)
+        thetas = np.linspace(-fov * 0.5, fov * 0.5, n_depth_ray, endpoint=False)
+        ray_dir_x = np.cos(thetas.reshape(1, -1) + headings.reshape(-1, 1))
+        ray_dir_y = np.sin(thetas.reshape(1, -1) + headings.reshape(-1, 1))
+        return np.stack([ray_dir_x, ray_dir_y], axis=-1)
+
+    def _march_rays(self, poses, headings, fov, n_depth_ray, resolution, n_steps):
+        # Fixed-step ray marching: every ray is sampled `n_steps` times at a step of `resolution`.
+        n_poses = poses.shape[0]
+        ray_dirs = self._ray_dirs(headings, fov, n_depth_ray)
+
+        # (N, n_steps, n_ray, 2)
+        ray_endpoints = poses.reshape((n_poses, 1, 1, 2)) + \
+                        ray_dirs.reshape(n_poses, 1, n_depth_ray, 2) * resolution * \
+                        np.arange(n_steps).reshape(1, n_steps, 1, 1)
         ray_grid_coords = self.grid_coord_batch(ray_endpoints.reshape(-1, 2))
 
-        # Note that ray_grid_coords contains x, y coordinates, whereas occupancy_grid.shape contains (height, width)
-        np.clip(ray_grid_coords[:, 0], 0, self.occupancy_grid.shape[1]-1, out=ray_grid_coords[:, 0])
-        np.clip(ray_grid_coords[:, 1], 0, self.occupancy_grid.shape[0]-1, out=ray_grid_coords[:, 1])
+        # Note that ray_grid_coords contains x, y coordinates, whereas self.shape contains (height, width)
+        np.clip(ray_grid_coords[:, 0], 0, self.shape[1]-1, out=ray_grid_coords[:, 0])
+        np.clip(ray_grid_coords[:, 1], 0, self.shape[0]-1, out=ray_grid_coords[:, 1])
 
-        values = self.occupancy_grid[ray_grid_coords[:, 1], ray_grid_coords[:, 0]].reshape(n_steps, n_depth_ray)
-        hits = values != 0
-        hits[-1, :] = 1
-        first_nonzero_idx = np.argmax(hits, axis=0)
+        hits = self.occupied(ray_grid_coords[:, 1], ray_grid_coords[:, 0]).reshape(n_poses, n_steps, n_depth_ray)
+        hits[:, -1, :] = 1
+        first_nonzero_idx = np.argmax(hits, axis=1)
         depth = first_nonzero_idx * resolution
 
         return depth
 
+    def _dda_rays(self, poses, headings, fov, n_depth_ray, resolution, n_steps, block_size=32):
+        # Exact grid traversal (Amanatides & Woo): every ray visits the cells it crosses in order and stops at the
+        # first occupied one, so thin diagonal walls cannot be skipped. Depths are the exact distances at which
+        # the rays enter the occupied cells. Rays leaving the map read the clamped border cells like
+        # _march_rays(), and the maximum depth is the same as for _march_rays() with this `resolution`.
+        ray_dirs = self._ray_dirs(headings, fov, n_depth_ray).reshape(-1, 2)
+
+        # everything below is in grid units (cells)
+        starts = (np.repeat(poses, n_depth_ray, axis=0) - np.array(self.origin)) * self.n_division
+        max_depth = (n_steps - 1) * resolution
+        max_t = max_depth * self.n_division
+
+        t_hit = self._traverse_cells(starts, ray_dirs, np.full(len(starts), max_t), block_size)
+        depth = np.where(t_hit < max_t, t_hit / self.n_division, max_depth)
+        return depth.reshape(-1, n_depth_ray)
+
+    def _traverse_cells(self, starts, ray_dirs, max_t, block_size=32):
+        # Grid traversal of _dda_rays() from `starts` (in cells) along `ray_dirs`. Returns the distance (in cells)
+        # at which every ray enters its first occupied cell, 0 if it starts in one and inf if it reaches its
+        # `max_t` first. To keep the Python loop short, every iteration checks the next `block_size` x and y
+        # cell boundary crossings of all rays that have not hit anything yet.
+        h, w = self.shape
+        n_rays = starts.shape[0]
+
+        cells = np.floor(starts).astype(np.int64)
+        cell_steps = np.where(ray_dirs >= 0, 1, -1)
+        # distance along the ray to the next x / y cell boundary and between two consecutive boundaries
+        with np.errstate(divide='ignore'):
+            t_delta = np.abs(1.0 / ray_dirs)
+            t_next = (cells + (cell_steps > 0) - starts) / ray_dirs
+        t_next[ray_dirs == 0] = np.inf
+
+        t_hits = np.full(n_rays, np.inf)
+        start_hit = self.occupied(np.clip(cells[:, 1], 0, h - 1), np.clip(cells[:, 0], 0, w - 1))
+        t_hits[start_hit] = 0
+
+        active = np.flatnonzero(~start_hit)
+        steps = np.arange(block_size).reshape(1, -1)
+        while len(active) > 0:
+            t_blocks = []
+            hits = []
+            for axis in range(2):
+                # the next crossings of the boundaries perpendicular to `axis` and the cells entered there
+                with np.errstate(invalid='ignore'):
+                    t_cross = t_next[active, axis:axis + 1] + steps * t_delta[active, axis:axis + 1]
+                t_cross[np.isnan(t_cross)] = np.inf
+                cross = np.empty(t_cross.shape + (2,), dtype=np.int64)
+                cross[:, :, axis] = cells[active, axis:axis + 1] + (steps + 1) * cell_steps[active, axis:axis + 1]
+                other = 1 - axis
+                with np.errstate(invalid='ignore'):
+                    cross[:, :, other] = np.floor(starts[active, other:other + 1] + ray_dirs[active, other:other + 1] *
+                                                  np.minimum(t_cross, max_t[active].reshape(-1, 1)))
+                t_blocks.append(t_cross)
+                hits.append(self.occupied(np.clip(cross[:, :, 1], 0, h - 1), np.clip(cross[:, :, 0], 0, w - 1)))
+
+            # crossings are only complete up to the end of the shorter of the two blocks
+            t_end = np.minimum(t_blocks[0][:, -1] + t_delta[active, 0], t_blocks[1][:, -1] + t_delta[active, 1])
+            t_hit = np.full(len(active), np.inf)
+            for t_cross, hit in zip(t_blocks, hits):
+                valid = hit & (t_cross < t_end.reshape(-1, 1))
+                t_hit = np.minimum(t_hit, np.where(valid, t_cross, np.inf).min(axis=1))
+
+            hit = t_hit < max_t[active]
+            t_hits[active[hit]] = t_hit[hit]
+
+            # move the remaining rays to the end of the block
+            for axis in range(2):
+                n_crossed = (t_blocks[axis] < t_end.reshape(-1, 1)).sum(axis=1)
+                ## rays parallel to the boundaries never cross them (0 * inf would give nan)
+                crossed = n_crossed > 0
+                t_next[active[crossed], axis] += n_crossed[crossed] * t_delta[active[crossed], axis]
+                cells[active, axis] += n_crossed * cell_steps[active, axis]
+            active = active[~hit & (t_end < max_t[active])]
+
+        return t_hits
+
+    def _sdf_rays(self, poses, headings, fov, n_depth_ray, resolution, n_steps):
+        # Sphere tracing on the distance field: every ray advances by the distance to the nearest obstacle, less
+        # the largest error of measuring it between cell centers, so no step can cross an occupied cell. Once that
+        # step would be shorter than `sdf_tolerance` (or `resolution`), the ray is finished with the exact
+        # traversal of _dda_rays(), so the depths are those of _dda_rays() and `sdf_tolerance` only trades
+        # sphere tracing steps for traversed cells. Rays leaving the map read the clamped border cells like
+        # _march_rays(). Clamping never makes the distance field overestimate the free space, so steps stay
+        # safe outside the map too.
+        h, w = self.shape
+        distance_field = self.get_distance_field()
+        ray_dirs = self._ray_dirs(headings, fov, n_depth_ray).reshape(-1, 2)
+        n_rays = ray_dirs.shape[0]
+
+        # everything below is in grid units (cells)
+        starts = (np.repeat(poses, n_depth_ray, axis=0) - np.array(self.origin)) * self.n_division
+        max_depth = (n_steps - 1) * resolution
+        max_t = max_depth * self.n_division
+        tolerance = self.sdf_tolerance if self.sdf_tolerance is not None else resolution
+        min_step = tolerance * self.n_division
+
+        t = np.zeros(n_rays)
+        near = np.zeros(n_rays, dtype=bool)
+        active = np.arange(n_rays)
+        while len(active) > 0:
+            points = starts[active] + ray_dirs[active] * t[active].reshape(-1, 1)
+            cell_x = np.clip(np.floor(points[:, 0]).astype(np.int64), 0, w - 1)
+            cell_y = np.clip(np.floor(points[:, 1]).astype(np.int64), 0, h - 1)
+
+            steps = distance_field[cell_y, cell_x] - np.sqrt(2)
+            ## occupied cells (at distance 0) are near too
+            near[active[steps < min_step]] = True
+            far = steps >= min_step
+            active = active[far]
+            t[active] += steps[far]
+            active = active[t[active] < max_t]
+
+        t_hit = np.full(n_rays, np.inf)
+        rays = np.flatnonzero(near)
+        t_hit[rays] = t[rays] + self._traverse_cells(starts[rays] + ray_dirs[rays] * t[rays].reshape(-1, 1),
+                                                     ray_dirs[rays], max_t - t[rays])
+        depth = np.where(t_hit < max_t, t_hit / self.n_division, max_depth)
+        return depth.reshape(-1, n_depth_ray)
+
+    def _lut_rays(self, poses, headings, fov, n_depth_ray, resolution, n_steps):
+        # Table lookup: the depth of every ray is read from the directional distance table at the cell of the
+        # pose and the nearest heading bin, so the error is about one cell plus the angular error of the bin.
+        # Rays grazing walls or passing by corners are the exception: there the nearest bin can turn a hit into
+        # a miss or the other way around, and the depth can be off by up to the full range.
+        h, w = self.shape
+        free_index, table, (row_offset, col_offset) = self.get_distance_table()
+        max_depth = (n_steps - 1) * resolution
+        n_bins = table.shape[0]
+
+        grid_coords = self.grid_coord_batch(poses)
+        cell_x = np.clip(grid_coords[:, 0], 0, w - 1) + col_offset
+        cell_y = np.clip(grid_coords[:, 1], 0, h - 1) + row_offset
+        columns = free_index[cell_y, cell_x].reshape(-1, 1)
+
+        thetas = np.linspace(-fov * 0.5, fov * 0.5, n_depth_ray, endpoint=False)
+        angles = thetas.reshape(1, -1) + headings.reshape(-1, 1)
+        bins = np.rint(angles * (n_bins / (2 * np.pi))).astype(np.int64) % n_bins
+
+        # distances are between cell centers, the obstacle is entered half a cell earlier. Capped distances (no
+        # obstacle in range) end up at the maximum depth.
+        distances = table[bins, np.maximum(columns, 0)].astype(np.float64)
+        depth = np.minimum(np.maximum(distances - 0.5, 0) / self.n_division, max_depth)
+        depth[columns.reshape(-1) < 0] = 0
+
+        if free_index.shape != (h, w):
+            # The table covers the full map. Rays leaving the crop instead read its clamped border cells, like
+            # in _march_rays(): they slide along the border column or row they leave through.
+            ray_dirs = self._ray_dirs(headings, fov, n_depth_ray).reshape(-1, 2)
+            starts = (np.repeat(poses, n_depth_ray, axis=0) - np.array(self.origin)) * self.n_division
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_exits = np.where(ray_dirs > 0, (np.array([w, h]) - starts) / ray_dirs,
+                                   np.where(ray_dirs < 0, -starts / ray_dirs, np.inf))
+            depth = depth.reshape(-1)
+            t_exit = np.maximum(t_exits.min(axis=1), 0)
+            leaving = np.flatnonzero(t_exit < depth * self.n_division)
+            depth[leaving] = np.minimum(self._border_hits(starts[leaving], ray_dirs[leaving],
+                                                          np.argmin(t_exits[leaving], axis=1), t_exit[leaving]) /
+                                        self.n_division, max_depth)
+            depth = depth.reshape(-1, n_depth_ray)
+        return depth
+
+    def _border_hits(self, starts, ray_dirs, exit_axes, t_exit):
+        # Distance (in cells) at which rays leaving the grid at `t_exit` through a side perpendicular to their
+        # `exit_axes` hit an occupied cell of that side's border column or row, inf if they do not.
+        h, w = self.shape
+        t_hit = np.full(len(starts), np.inf)
+        for axis in range(2):
+            other = 1 - axis
+            for forward in (False, True):
+                rays = np.flatnonzero((exit_axes == axis) & ((ray_dirs[:, axis] > 0) == forward))
+                if len(rays) == 0:
+                    continue
+                border = (w - 1 if forward else 0) if axis == 0 else (h - 1 if forward else 0)
+                n = h if axis == 0 else w
+                line = self.occupied(np.arange(n), np.full(n, border)) if axis == 0 else \
+                    self.occupied(np.full(n, border), np.arange(n))
+                # for every cell of the line, the next occupied cell at or after / at or before it
+                next_occupied = np.minimum.accumulate(np.where(line, np.arange(n), n)[::-1])[::-1]
+                prev_occupied = np.maximum.accumulate(np.where(line, np.arange(n), -1))
+
+                start, direction, t0 = starts[rays, other], ray_dirs[rays, other], t_exit[rays]
+                cell = np.clip(np.floor(start + direction * t0).astype(np.int64), 0, n - 1)
+                hit_cell = np.where(direction > 0, next_occupied[cell],
+                                    np.where(direction < 0, prev_occupied[cell], np.where(line[cell], cell, -1)))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    t = np.where(hit_cell == cell, t0, (hit_cell + (direction < 0) - start) / direction)
+                found = (hit_cell >= 0) & (hit_cell < n)
+                t_hit[rays[found]] = np.maximum(t[found], t0[found])
+        return t_hit
+
     def local_to_global(self, pos, heading, xys):
         '''
         Transform local points into the global coordinate system
@@ -12,7 +12,7 @@ def fig2data(fig):
 
     # Get the RGBA buffer from the figure
     w, h = fig.canvas.get_width_height()
-    buf = numpy.fromstring(fig.canvas.tostring_argb(), dtype=numpy.uint8)
+    buf = numpy.frombuffer(fig.canvas.tostring_argb(), dtype=numpy.uint8)
     buf.shape = (w, h, 4)
 
     # canvas.tostring_argb give pixmap in ARGB mode. Roll the ALPHA channel to have it in RGBA mode
@@ -28,60 +28,370 @@ def fig2img ( fig ):
     # put the figure pixmap into a numpy array
     buf = fig2data ( fig )
     w, h, d = buf.shape
-    return Image.frombytes( "RGBA", ( w ,h ), buf.tostring( ) )
+    return Image.frombytes( "RGBA", ( w ,h ), buf.tobytes( ) )
 
 def data2img(buf):
     w, h, d = buf.shape
-    return Image.frombytes("RGBA", (w, h), buf.tostring())
+    return Image.frombytes("RGBA", (w, h), buf.tobytes())
 
+import abc, heapq, math
+import cv2
 import numpy as np
 
 
-class AStarPlanner(object):
+class GridPlanner(abc.ABC):
+    '''
+    Base class of the planners on the 8-connected grid of a MapEnvironment (see `planner_protocol`).
+    `Plan(start_config, goal_config)` returns a [2 x n] numpy array of the cells (x, y) from start to goal;
+    `expanded` counts the nodes expanded so far.
+    '''
+    ## (dx, dy) of the 8 neighbors, in the order they are pushed
+    moves = [(i, j) for i in range(-1, 2) for j in range(-1, 2) if not (i == 0 and j == 0)]
+
     def __init__(self, planning_env, epsilon):
+        '''
+        :param planning_env: a MapEnvironment.
+        :param epsilon: weight of the heuristic.
+        '''
         self.env = planning_env
         self.nodes = {}
         self.epsilon = epsilon
         self.visited = np.zeros(self.env.map.shape)
+        self.expanded = 0
 
+    @abc.abstractmethod
     def Plan(self, start_config, goal_config):
-        # TODO: YOUR IMPLEMENTATION HERE
+        '''
+        :param start_config: a [2 x 1] numpy array of the start cell (x, y).
+        :param goal_config: a [2 x 1] numpy array of the goal cell (x, y).
+        :return: a [2 x n] numpy array of the cells from start to goal.
+        '''
+
+    @classmethod
+    def neighbor_mask(cls, free):
+        '''
+        :param free: boolean grid of the valid cells.
+        :return: uint8 grid whose bit k is set where the k-th neighbor (see `moves`) is valid.
+        '''
+        h, w = free.shape
+        padded = np.zeros((h + 2, w + 2), dtype=bool)
+        padded[1:-1, 1:-1] = free
+        mask = np.zeros((h, w), dtype=np.uint8)
+        for k, (dx, dy) in enumerate(cls.moves):
+            mask |= padded[1 + dy:1 + dy + h, 1 + dx:1 + dx + w].astype(np.uint8) << k
+        return mask
+
+
+class AStarPlanner(GridPlanner):
+    '''
+    Weighted A*, f = g + epsilon * h with h the euclidean distance to the goal. The open set is a binary heap of
+    integer cell ids (y * width + x), ties are broken by insertion order, and paths are rebuilt from a parent
+    array. On the same MapEnvironment, plans to reachable goals have the same cost as those of the sorted-list
+    version this replaces (scripts/planner_benchmark.py --legacy compares the two).
+    '''
+
+    def Plan(self, start_config, goal_config):
+        '''
+        :param start_config: a [2 x 1] numpy array of the start cell (x, y).
+        :param goal_config: a [2 x 1] numpy array of the goal cell (x, y).
+        :return: a [2 x n] numpy array of the cells from start to goal. If the goal cannot be reached, the path to
+                 the last expanded cell.
+        '''
+        h, w = self.env.map.shape
+        mask = self.neighbor_mask(self.env.map == 0).ravel().tolist()
+        offsets = [dy * w + dx for dx, dy in self.moves]
+        costs = [math.sqrt(dx * dx + dy * dy) for dx, dy in self.moves]
+        goal_x, goal_y = int(goal_config[0, 0]), int(goal_config[1, 0])
+        goal_tolerance = self.env.epsilon
+
+        visited = bytearray(h * w)
+        parents = [-1] * (h * w)
+        best = [math.inf] * (h * w)
+        start = int(start_config[1, 0]) * w + int(start_config[0, 0])
+        heap = [(0, 0, start, 0, -1)] ## (f, insertion count, cell, g, parent)
+        count = 1
+        last = start
+        while heap:
+            _, _, cell, g, parent = heapq.heappop(heap)
+            if visited[cell]:
+                continue
+            visited[cell] = 1
+            parents[cell] = parent
+            last = cell
+            self.expanded += 1
+            y, x = divmod(cell, w)
+            if math.sqrt((x - goal_x) ** 2 + (y - goal_y) ** 2) < goal_tolerance:
+                break
+            bits = mask[cell]
+            for k in range(8):
+                if not bits >> k & 1:
+                    continue
+                n = cell + offsets[k]
+                n_g = g + costs[k]
+                ## a later entry with a cost that is not lower would never be expanded first
+                if visited[n] or n_g >= best[n]:
+                    continue
+                best[n] = n_g
+                dx, dy = self.moves[k]
+                n_h = math.sqrt((x + dx - goal_x) ** 2 + (y + dy - goal_y) ** 2)
+                heapq.heappush(heap, (n_g + self.epsilon * n_h, count, n, n_g, cell))
+                count += 1
+        self.visited = np.frombuffer(bytes(visited), dtype=np.uint8).reshape(h, w)
+
+        path = []
+        while last != -1:
+            path.append(last)
+            last = parents[last]
+        path = np.array(path[::-1])
+        return np.array([path % w, path // w], dtype=np.result_type(start_config))
+
+
+class DijkstraPlanner(AStarPlanner):
+    '''
+    Dijkstra, i.e. A* without heuristic. Returns shortest paths, at the cost of expanding every cell closer than
+    the goal.
+    '''
+
+    def __init__(self, planning_env, epsilon=0):
+        super(DijkstraPlanner, self).__init__(planning_env, 0)
+
+
+class JPSPlanner(GridPlanner):
+    '''
+    Jump point search (Harabor and Grastien, 2011), with the same moves as AStarPlanner: diagonal moves are allowed
+    whenever the diagonal cell is free. Only jump points go through the heap, the straight and diagonal runs
+    between them are scanned, so far fewer nodes are expanded than by A* on open grids. The heuristic is weighted
+    by epsilon as in AStarPlanner, and jumps stop at the goal cell itself.
+    '''
+
+    def jump(self, free, cell, dx, dy, goal, width):
+        '''
+        Scan from `cell` in direction (dx, dy) on the padded flat grid `free`.
+        :return: the next jump point, or -1 if the scan runs into an obstacle.
+        '''
+        step = dy * width + dx
+        while True:
+            cell += step
+            if not free[cell]:
+                return -1
+            if cell == goal:
+                return cell
+            if dx and dy:
+                ## forced neighbors, or a jump point on one of the straight scans
+                if (not free[cell - dx] and free[cell - dx + dy * width]) or \
+                        (not free[cell - dy * width] and free[cell + dx - dy * width]):
+                    return cell
+                if self.jump(free, cell, dx, 0, goal, width) != -1 or self.jump(free, cell, 0, dy, goal, width) != -1:
+                    return cell
+            elif dx:
+                if (not free[cell + width] and free[cell + width + dx]) or \
+                        (not free[cell - width] and free[cell - width + dx]):
+                    return cell
+            else:
+                if (not free[cell + 1] and free[cell + 1 + dy * width]) or \
+                        (not free[cell - 1] and free[cell - 1 + dy * width]):
+                    return cell
+
+    def successors(self, free, cell, dx, dy, width):
+        '''
+        :return: the directions to scan from a jump point reached in direction (dx, dy), natural and forced.
+        '''
+        if dx == 0 and dy == 0:
+            return self.moves
+        if dx and dy:
+            dirs = [(dx, 0), (0, dy), (dx, dy)]
+            if not free[cell - dx]:
+                dirs.append((-dx, dy))
+            if not free[cell - dy * width]:
+                dirs.append((dx, -dy))
+        elif dx:
+            dirs = [(dx, 0)]
+            if not free[cell + width]:
+                dirs.append((dx, 1))
+            if not free[cell - width]:
+                dirs.append((dx, -1))
+        else:
+            dirs = [(0, dy)]
+            if not free[cell + 1]:
+                dirs.append((1, dy))
+            if not free[cell - 1]:
+                dirs.append((-1, dy))
+        return dirs
+
+    def Plan(self, start_config, goal_config):
+        '''
+        :param start_config: a [2 x 1] numpy array of the start cell (x, y).
+        :param goal_config: a [2 x 1] numpy array of the goal cell (x, y).
+        :return: a [2 x n] numpy array of all the cells from start to goal. If the goal cannot be reached, the path
+                 to the last expanded jump point.
+        '''
+        h, w = self.env.map.shape
+        ## padded with obstacles, no bound checks needed
+        width = w + 2
+        free = np.zeros((h + 2, width), dtype=bool)
+        free[1:-1, 1:-1] = self.env.map == 0
+        free = free.ravel().tolist()
+        goal_x, goal_y = int(goal_config[0, 0]), int(goal_config[1, 0])
+        goal = (goal_y + 1) * width + goal_x + 1
+        goal_tolerance = self.env.epsilon
+
+        visited = bytearray((h + 2) * width)
+        parents = {}
+        best = {}
+        start = (int(start_config[1, 0]) + 1) * width + int(start_config[0, 0]) + 1
+        heap = [(0, 0, start, 0, -1)] ## (f, insertion count, cell, g, parent)
+        count = 1
+        last = start
+        while heap:
+            _, _, cell, g, parent = heapq.heappop(heap)
+            if visited[cell]:
+                continue
+            visited[cell] = 1
+            parents[cell] = parent
+            last = cell
+            self.expanded += 1
+            y, x = divmod(cell, width)
+            if math.sqrt((x - 1 - goal_x) ** 2 + (y - 1 - goal_y) ** 2) < goal_tolerance:
+                break
+            if parent == -1:
+                directions = self.successors(free, cell, 0, 0, width)
+            else:
+                py, px = divmod(parent, width)
+                directions = self.successors(free, cell, (x > px) - (x < px), (y > py) - (y < py), width)
+            for dx, dy in directions:
+                n = self.jump(free, cell, dx, dy, goal, width)
+                if n == -1 or visited[n]:
+                    continue
+                ny, nx = divmod(n, width)
+                n_g = g + max(abs(nx - x), abs(ny - y)) * (math.sqrt(2) if dx and dy else 1)
+                if n_g >= best.get(n, math.inf):
+                    continue
+                best[n] = n_g
+                n_h = math.sqrt((nx - 1 - goal_x) ** 2 + (ny - 1 - goal_y) ** 2)
+                heapq.heappush(heap, (n_g + self.epsilon * n_h, count, n, n_g, cell))
+                count += 1
+        self.visited = np.frombuffer(bytes(visited), dtype=np.uint8).reshape(h + 2, width)[1:-1, 1:-1]
 
-        q = [start_config]
-        c = [0]
-        a_c = [0]
-        while len(q) > 0:
-            current = q.pop(0)
-            _ = c.pop(0)
-            current_action_cost = a_c.pop(0)
-            last_x, last_y = current[:, -1]
-            if not self.visited[int(last_y), int(last_x)]:
-                self.visited[int(last_y), int(last_x)] = 1
-                if self.env.goal_criterion(np.array([[last_x], [last_y]]), goal_config):
+        ## fill in the straight and diagonal runs between jump points
+        xs, ys = [], []
+        while last != -1:
+            y, x = divmod(last, width)
+            parent = parents[last]
+            if parent == -1:
+                xs.append(x - 1)
+                ys.append(y - 1)
+            else:
+                py, px = divmod(parent, width)
+                n = max(abs(x - px), abs(y - py))
+                dx, dy = (x > px) - (x < px), (y > py) - (y < py)
+                xs += [x - 1 - i * dx for i in range(n)]
+                ys += [y - 1 - i * dy for i in range(n)]
+            last = parent
+        return np.array([xs[::-1], ys[::-1]], dtype=np.result_type(start_config))
+
+
+class GeodesicField(object):
+    '''
+    Breadth-first hop counts from a start cell over the 8-connected free cells of a grid (the moves of the
+    planners). The wavefront is grown with one dilation per hop inside the bounding box of the start component,
+    and only as far as needed: `cells` grows it to `min_hops`, `path_to` until the goal is reached. Every cell of
+    the component is a valid goal and `path_to` gets a shortest path (in moves) to it by descending the field,
+    so no search is needed per goal.
+    '''
+    ## neighbors tried first when descending, straight before diagonal
+    moves = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+    kernel = np.ones((3, 3), dtype=np.uint8)
+
+    def __init__(self, free, start_config, labels=None, stats=None):
+        '''
+        :param free: boolean grid of the free cells.
+        :param start_config: a [2 x 1] numpy array of the start cell (x, y), must be free.
+        :param labels, stats: the 8-connected components of `free`, from cv2.connectedComponentsWithStats.
+                              Computed if not given.
+        '''
+        if labels is None:
+            _, labels, stats, _ = cv2.connectedComponentsWithStats(free.astype(np.uint8), connectivity=8)
+        self.shape = free.shape
+        self.dtype = np.result_type(start_config)
+        start_x, start_y = int(start_config[0, 0]), int(start_config[1, 0])
+        label = labels[start_y, start_x]
+        assert label > 0, "the start cell must be free"
+
+        ## only the component of the start is reachable
+        self.x0, self.y0, w, h = stats[label, :4]
+        self.component = (labels[self.y0:self.y0 + h, self.x0:self.x0 + w] == label).astype(np.uint8)
+        self.size = stats[label, cv2.CC_STAT_AREA]
+        self.frontier = np.zeros_like(self.component)
+        self.frontier[start_y - self.y0, start_x - self.x0] = 1
+        self.unreached = self.component - self.frontier
+        ## cells reached so far hold their hop count, the others the hop count of the current wavefront
+        self.window_hops = np.zeros((h, w), dtype=np.int32)
+        self.n = 0
+        self.complete = self.size == 1
+
+    def grow(self, max_hops=None, goal=None):
+        '''
+        Advance the wavefront until it is `max_hops` hops away, reaches the cell `goal` (x, y), or covers the component.
+        '''
+        while not self.complete and (max_hops is None or self.n < max_hops) and \
+                (goal is None or self.unreached[goal[1] - self.y0, goal[0] - self.x0]):
+            self.n += 1
+            ## every cell not reached before this hop gets one more
+            self.window_hops += self.unreached
+            self.frontier = cv2.dilate(self.frontier, self.kernel) & self.unreached
+            self.unreached -= self.frontier
+            self.complete = not self.unreached.any()
+
+    @property
+    def hops(self):
+        '''
+        :return: grid of the hop counts from the start, -1 where not reachable or not reached yet.
+        '''
+        hops = np.full(self.shape, -1, dtype=np.int32)
+        h, w = self.component.shape
+        hops[self.y0:self.y0 + h, self.x0:self.x0 + w] = np.where(
+            self.component.astype(bool) & (self.unreached == 0), self.window_hops, -1)
+        return hops
+
+    def cells(self, min_hops=0):
+        '''
+        :return: a [2 x n] numpy array of the reachable cells (x, y) at least `min_hops` moves from the start.
+        '''
+        self.grow(max_hops=min_hops)
+        ys, xs = np.nonzero(self.component.astype(bool) & ((self.window_hops >= min_hops) | (self.unreached > 0)))
+        return np.array([xs + self.x0, ys + self.y0], dtype=self.dtype)
+
+    def path_to(self, goal_config):
+        '''
+        :param goal_config: a [2 x 1] numpy array of a reachable goal cell (x, y).
+        :return: a [2 x n] numpy array of the cells from start to goal, n - 1 being the hop count of the goal.
+        '''
+        goal = int(goal_config[0, 0]), int(goal_config[1, 0])
+        h, w = self.component.shape
+        assert 0 <= goal[0] - self.x0 < w and 0 <= goal[1] - self.y0 < h and \
+            self.component[goal[1] - self.y0, goal[0] - self.x0], "the goal cell is not reachable"
+        self.grow(goal=goal)
+
+        ## only cells closer than the goal are needed, they are all reached
+        hops = np.pad(np.where(self.component.astype(bool), self.window_hops, -1), 1, constant_values=-1)
+        x, y = goal[0] - self.x0 + 1, goal[1] - self.y0 + 1
+        n = hops[y, x]
+        xs, ys = [goal[0]], [goal[1]]
+        dx, dy = 0, 0
+        while n > 0:
+            ## keep the last direction when possible, for straighter paths
+            for dx, dy in [(dx, dy)] + self.moves:
+                if (dx or dy) and hops[y - dy, x - dx] == n - 1:
                     break
-                next_states = []
-                next_cost = []
-                for i in range(-1, 2):
-                    for j in range(-1, 2):
-                        if i == 0 and j == 0:
-                            continue
-                        next_states.append(np.array([[last_x + i], [last_y + j]]))
-                        next_cost.append(self.env.compute_distance(np.array([[last_x + i], [last_y + j]]),
-                                                                   np.array([[last_x], [last_y]])))
-                for i, state in enumerate(next_states):
-                    if self.env.state_validity_checker(state):
-                        q.append(np.hstack([current, state]))
-                        cost = current_action_cost + next_cost[i]
-                        a_c.append(cost)
-                        cost += self.epsilon * self.env.h(np.hstack([state, goal_config]))
-                        c.append(cost)
-                idx = sorted(range(len(c)), key=lambda k: c[k])
-                q = [q[idy] for idy in idx]
-                c = [c[idy] for idy in idx]
-                a_c = [a_c[idy] for idy in idx]
-        plan = current.tolist()
-
-        return np.array(plan)
+            x, y, n = x - dx, y - dy, n - 1
+            xs.append(x - 1 + self.x0)
+            ys.append(y - 1 + self.y0)
+        return np.array([xs[::-1], ys[::-1]], dtype=self.dtype)
+
+
+planner_protocol = {"astar": AStarPlanner,
+                    "dijkstra": DijkstraPlanner,
+                    "jps": JPSPlanner,}
 
 
 class MapEnvironment(object):
@@ -126,20 +436,42 @@ class MapEnvironment(object):
         dis = ((start_config - end_config) ** 2).sum() ** 0.5
         return dis
 
+    def states_validity(self, config):
+        """ Return a boolean mask of the valid states
+
+            @param config: a [2 x n] numpy array of states
+        """
+        x, y = config[0], config[1]
+        valid = (x >= self.xlimit[0]) & (x <= self.xlimit[1]) & (y >= self.ylimit[0]) & (y <= self.ylimit[1])
+        ## out of bounds states read cell (0, 0) and are masked out
+        xi = np.where(valid, x, 0).astype(int)
+        yi = np.where(valid, y, 0).astype(int)
+        return valid & (self.map[yi, xi] == 0)
+
     def state_validity_checker(self, config):
         """ Return True if all states are valid
 
             @param config: a [2 x n] numpy array of states
         """
-        # TODO: YOUR IMPLEMENTATION HERE
-        for i in range(config.shape[1]):
-            if config[0, i] < self.xlimit[0] or config[0, i] > self.xlimit[1]:
-                return False
-            if config[1, i] < self.ylimit[0] or config[1, i] > self.ylimit[1]:
-                return False
-            if self.map[int(config[1, i]), int(config[0, i])] == 1.0:
-                return False
-        return True
+        return bool(self.states_validity(config).all())
+
+    def edges_validity(self, configs1, configs2, step=0.25):
+        """ Return a boolean mask of the valid edges
+
+            @param configs1: a [2 x n] numpy array of the first states of the edges
+            @param configs2: a [2 x n] numpy array of the second states of the edges
+            @param step: max distance between the states checked along an edge, in cells
+        """
+        configs1 = np.asarray(configs1, dtype=float)
+        configs2 = np.asarray(configs2, dtype=float)
+        length = np.sqrt(((configs2 - configs1) ** 2).sum(0))
+        ## per edge number of samples, both ends included
+        counts = np.ceil(length / step).astype(int) + 1
+        starts = np.cumsum(counts) - counts
+        edge = np.repeat(np.arange(len(counts)), counts)
+        t = (np.arange(counts.sum()) - starts[edge]) / np.maximum(counts[edge] - 1, 1)
+        configs = configs1[:, edge] + (configs2 - configs1)[:, edge] * t
+        return np.logical_and.reduceat(self.states_validity(configs), starts)
 
     def edge_validity_checker(self, config1, config2):
         """ Return True if edge is valid
@@ -149,11 +481,7 @@ class MapEnvironment(object):
         """
         assert (config1.shape == (2, 1))
         assert (config2.shape == (2, 1))
-        n = max(self.xlimit[1], self.ylimit[1])
-        x_vals = np.linspace(config1[0], config2[0], n).reshape(1, n)
-        y_vals = np.linspace(config1[1], config2[1], n).reshape(1, n)
-        configs = np.vstack((x_vals, y_vals))
-        return self.state_validity_checker(configs)
+        return bool(self.edges_validity(config1, config2)[0])
 
     def h(self, config):
         """ Heuristic function for A*